@@ -0,0 +1,78 @@
+"""
+Compares rows/sec of generic.utils.unicode_csv.Writer.writerows against the
+original row-at-a-time implementation.
+
+    python benchmarks/unicode_csv_writer.py [rows]
+"""
+import codecs
+import csv
+import cStringIO
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from generic.utils.unicode_csv import Writer
+
+
+class OriginalWriter:
+    """ unicode_csv.Writer as it was before batching """
+    def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
+        self.queue = cStringIO.StringIO()
+        self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
+        self.stream = f
+        self.encoder = codecs.getincrementalencoder(encoding)()
+
+    def writerow(self, row):
+        def stringify(value):
+            if isinstance(value, unicode):
+                pass
+            elif isinstance(value, basestring):
+                value = value.decode('utf-8')
+            elif hasattr(value, '__unicode__'):
+                value = unicode(value)
+            elif hasattr(value, '__str__'):
+                value = str(value).decode('utf-8')
+            else:
+                raise NotImplementedError
+            return value.encode('utf-8')
+        self.writer.writerow(map(stringify, row))
+        data = self.queue.getvalue()
+        data = data.decode("utf-8")
+        data = self.encoder.encode(data)
+        self.stream.write(data)
+        self.queue.truncate(0)
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+
+def get_rows(count):
+    today = datetime.date.today()
+    return [
+        [i, u'Caf\xe9 number %d' % i, 'plain bytes', i * 1.5, today, None]
+        for i in xrange(count)
+    ]
+
+
+def benchmark(writer_class, rows, encoding):
+    output = cStringIO.StringIO()
+    writer = writer_class(output, encoding=encoding)
+    start = time.time()
+    writer.writerows(rows)
+    elapsed = time.time() - start
+    return len(rows) / elapsed, output.getvalue()
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    rows = get_rows(count)
+    for encoding in ('utf-8', 'utf-16'):
+        before, before_output = benchmark(OriginalWriter, rows, encoding)
+        after, after_output = benchmark(Writer, rows, encoding)
+        assert before_output == after_output
+        print '%-7s before: %9d rows/sec  after: %9d rows/sec  (x%.2f)' % (
+            encoding, before, after, after / before)
@@ -5,6 +5,7 @@ from .cooking import (
     StackedInlineCookedIdAdmin,
 )
 from .csv import CSVExportAdmin
+from .csv_import import CSVImportAdmin
 from .delible import DelibleAdmin
 from .owrt import OWRTInline, OWRTStackedInline
 from .related import ChangeFormOnlyAdmin, ChangeLinkInline
@@ -1,20 +1,42 @@
+import base64
+import collections
+import logging
+import time
+import uuid
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 from django import forms
 from django import http
 try:
     from django.conf.urls import patterns, url
 except ImportError:
     from django.conf.urls.defaults import patterns, url
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.admin import helpers
+try:
+    from django.contrib.admin.utils import display_for_field
+except ImportError:
+    from django.contrib.admin.util import display_for_field # django < 1.7
+from django.contrib.admin.views.main import EMPTY_CHANGELIST_VALUE
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import DatabaseError, models, transaction
+from django.db.models import Count, Q, signals
 from django.template.response import TemplateResponse
+from django.utils.encoding import force_text
 from django.utils.translation import ungettext_lazy, ugettext_lazy as _
 from copy import copy
+from ...utils.querysets import (
+    IN_CHUNK_SIZE, iterate_pk_ranges, filter_pk_range)
+
+logger = logging.getLogger(__name__)
 
 M2M_REMOVE_PREFIX = 'm2m_remove_'
 M2M_ADD_PREFIX = 'm2m_add_'
+SELECTION_SESSION_KEY_PREFIX = 'generic-batch-update-'
 
 
 class BatchUpdateForm(forms.ModelForm):
@@ -62,9 +84,14 @@ class BatchUpdateForm(forms.ModelForm):
                 [_("You haven't selected any fields to update")])
         return cleaned_data
 
-    def apply(self, request, queryset):
+    def get_updates(self):
+        """
+        Returns the updates to make: a dict of values for `update()`, and a
+        list of (action, field, related objects) for many-to-many fields,
+        where action is 'add' or 'remove'.
+        """
         update_params = {}
-        updated = 0
+        m2m_updates = []
         for field_name in self.fields_to_update:
 
             if field_name.startswith(M2M_REMOVE_PREFIX):
@@ -74,30 +101,193 @@ class BatchUpdateForm(forms.ModelForm):
             else:
                 model_field_name = field_name
 
-            field = queryset.model._meta.get_field(model_field_name)
+            field = self._meta.model._meta.get_field(model_field_name)
             if isinstance(field, models.ManyToManyField):
 
                 if field_name.startswith(M2M_REMOVE_PREFIX):
-                    for obj in queryset.all():
-                        for related_obj in self.cleaned_data[field_name]:
-                            getattr(obj, model_field_name).remove(related_obj)
-                        updated += 1
+                    m2m_updates.append((
+                        'remove', field, self.cleaned_data[field_name]))
 
                 if field_name.startswith(M2M_ADD_PREFIX):
-                    for obj in queryset.all():
-                        for related_obj in self.cleaned_data[field_name]:
-                            getattr(obj, model_field_name).add(related_obj)
-                        updated += 1
+                    m2m_updates.append((
+                        'add', field, self.cleaned_data[field_name]))
 
             else:
                 update_params[field_name] = self.cleaned_data[field_name]
+        return update_params, m2m_updates
+
+    def apply(self, request, queryset):
+        return self.apply_in_chunks(request, [queryset])
 
+    def apply_in_chunks(
+            self, request, querysets, save=False, atomic=False,
+            progress=None):
+        """
+        As `apply`, for a selection split into several querysets (e.g.
+        pk-ordered chunks of it), which are updated in turn.
+
+        If `atomic`, each chunk is updated in its own transaction. If `save`,
+        each object is saved individually so that its save() and signals
+        run, though still loaded a chunk at a time. `progress` is called
+        after each chunk with the numbers of chunks and objects done.
+        """
+        update_params, m2m_updates = self.get_updates()
         self._restore_fields_to_update()
 
-        if update_params:
-            updated = queryset.update(**update_params)
+        updated = 0
+        for chunks, queryset in enumerate(querysets, 1):
+            if atomic:
+                with transaction.atomic(using=queryset.db):
+                    updated += self.apply_chunk(
+                        queryset, update_params, m2m_updates, save)
+            else:
+                updated += self.apply_chunk(
+                    queryset, update_params, m2m_updates, save)
+            if progress:
+                progress(chunks, updated)
         return updated
 
+    def apply_chunk(self, queryset, update_params, m2m_updates, save=False):
+        """
+        Applies the updates to `queryset`, skipping objects which already
+        have all the new values rather than rewriting them unchanged.
+        Returns the number of objects changed.
+        """
+        changed_pks = set()
+        for action, field, related_objs in m2m_updates:
+            apply_m2m = getattr(self, 'apply_m2m_%s' % action)
+            changed_pks.update(apply_m2m(queryset, field, related_objs))
+        if not update_params:
+            return len(changed_pks)
+        queryset = queryset.exclude(**update_params)
+        if save:
+            objs = list(queryset.order_by('pk'))
+            for obj in objs:
+                for name, value in update_params.iteritems():
+                    setattr(obj, name, value)
+                # every field, as save() and pre_save may change others
+                # (e.g. auto_now ones)
+                obj.save(using=queryset.db)
+            return len(changed_pks.union(obj.pk for obj in objs))
+        if not changed_pks:
+            return queryset.update(**update_params)
+        pks = set(queryset.values_list('pk', flat=True))
+        queryset.model._default_manager.using(queryset.db).filter(
+            pk__in=pks).update(**update_params)
+        return len(changed_pks.union(pks))
+
+    def _get_m2m_through(self, field):
+        through = field.rel.through
+        source = through._meta.get_field(field.m2m_field_name())
+        target = through._meta.get_field(field.m2m_reverse_field_name())
+        return through, source, target
+
+    def _is_symmetrical(self, field):
+        """ Whether `field` is a symmetrical relation to its own model """
+        through, source, target = self._get_m2m_through(field)
+        return field.rel.symmetrical and source.rel.to == target.rel.to
+
+    def _get_m2m_lookup(self, field, queryset, related_pks):
+        """
+        Returns a Q for the through rows between `queryset` and
+        `related_pks`, including the mirrored ones of symmetrical fields.
+        """
+        through, source, target = self._get_m2m_through(field)
+        lookup = Q(**{
+            '%s__in' % source.name: queryset.values('pk'),
+            '%s__in' % target.name: related_pks,
+        })
+        if self._is_symmetrical(field):
+            lookup |= Q(**{
+                '%s__in' % source.name: related_pks,
+                '%s__in' % target.name: queryset.values('pk'),
+            })
+        return lookup
+
+    def _send_m2m_changed(self, action, queryset, field, related, pairs):
+        """
+        Sends m2m_changed once per related object, from its (i.e. the
+        reverse) side, with the pks of all the objects in the batch.
+        """
+        pks_by_related = {}
+        for pk, related_pk in pairs:
+            pks_by_related.setdefault(related_pk, set()).add(pk)
+        for related_pk, pks in pks_by_related.iteritems():
+            signals.m2m_changed.send(
+                sender=field.rel.through,
+                action=action,
+                instance=related[related_pk],
+                reverse=True,
+                model=queryset.model,
+                pk_set=pks,
+                using=queryset.db,
+            )
+
+    def apply_m2m_add(self, queryset, field, related_objs):
+        """
+        Adds `related_objs` to the `field` of every object in `queryset`
+        with one query for the existing relationships and one bulk insert
+        for the missing ones (both ways round, for a symmetrical field).
+        Returns the pks of the objects changed.
+        """
+        through, source, target = self._get_m2m_through(field)
+        related = dict((obj.pk, obj) for obj in related_objs)
+        related_pks = set(related)
+        if not related_pks:
+            return set()
+        existing = set(
+            through._default_manager.using(queryset.db).filter(
+                self._get_m2m_lookup(field, queryset, related_pks),
+            ).values_list(source.name, target.name)
+        )
+        missing = [
+            (pk, related_pk)
+            for pk in queryset.values_list('pk', flat=True)
+            for related_pk in related_pks
+            if not (pk, related_pk) in existing
+        ]
+        rows = list(missing)
+        if self._is_symmetrical(field):
+            rows.extend(set(
+                (related_pk, pk) for pk, related_pk in missing
+                if not (related_pk, pk) in existing
+            ).difference(missing))
+        if missing:
+            self._send_m2m_changed(
+                'pre_add', queryset, field, related, missing)
+            through._default_manager.using(queryset.db).bulk_create([
+                through(**{source.attname: pk, target.attname: related_pk})
+                for pk, related_pk in rows
+            ])
+            self._send_m2m_changed(
+                'post_add', queryset, field, related, missing)
+        return set(pk for pk, related_pk in missing)
+
+    def apply_m2m_remove(self, queryset, field, related_objs):
+        """
+        Removes `related_objs` from the `field` of every object in
+        `queryset` with a single delete (of the mirrored relationships too,
+        for a symmetrical field). Returns the pks of the objects changed.
+        """
+        through, source, target = self._get_m2m_through(field)
+        related = dict((obj.pk, obj) for obj in related_objs)
+        related_pks = set(related)
+        if not related_pks:
+            return set()
+        manager = through._default_manager.using(queryset.db)
+        removed = list(manager.filter(**{
+            '%s__in' % source.name: queryset.values('pk'),
+            '%s__in' % target.name: related_pks,
+        }).values_list(source.name, target.name))
+        if removed:
+            self._send_m2m_changed(
+                'pre_remove', queryset, field, related, removed)
+            manager.filter(
+                self._get_m2m_lookup(field, queryset, related_pks)).delete()
+            self._send_m2m_changed(
+                'post_remove', queryset, field, related, removed)
+        return set(pk for pk, related_pk in removed)
+
     def _restore_fields_to_update(self):
         new_list = []
         for field_name in self.fields_to_update:
@@ -113,6 +303,18 @@ class BatchUpdateForm(forms.ModelForm):
 
 class BatchUpdateAdmin(admin.ModelAdmin):
     batch_update_fields = ()
+    batch_update_chunk_size = IN_CHUNK_SIZE
+    # Commit each chunk separately, so that locks are only ever held on
+    # batch_update_chunk_size rows rather than the whole selection; if
+    # False, the whole update is a single transaction.
+    batch_update_chunked = False
+    # Save objects individually so that their save() and signals run
+    batch_update_save = False
+    # The number of current values to show for each field in the preview
+    batch_update_preview_values = 10
+    # Selections are kept in the session for this many seconds, and only the
+    # latest for each model, so that they don't accumulate (e.g. in cookies)
+    batch_update_selection_timeout = 60 * 60
 
     def _get_url_name(self, view_name, include_namespace=True):
         return '%s%s_%s_%s' % (
@@ -123,17 +325,98 @@ class BatchUpdateAdmin(admin.ModelAdmin):
         )
 
     def batch_update(self, request, queryset):
-        selected = request.POST.getlist(admin.ACTION_CHECKBOX_NAME)
         return http.HttpResponseRedirect(
-            '%s?ids=%s' % (
+            '%s?selection=%s' % (
                 reverse(
                     self._get_url_name('batchupdate'),
                     current_app=self.admin_site.name,
                 ),
-                ','.join(selected),
+                self.save_batch_update_selection(request, queryset),
             )
         )
 
+    def _get_selection_session_key(self):
+        return '%s%s-%s' % (
+            SELECTION_SESSION_KEY_PREFIX,
+            self.model._meta.app_label,
+            self.model._meta.model_name,
+        )
+
+    def save_batch_update_selection(self, request, queryset):
+        """
+        Stores the objects selected for a batch update in the session, in
+        place of any earlier selection of this model, and returns a token to
+        find them by. An explicit selection is stored as pks, and "select
+        all" as the query of the filtered change list.
+        """
+        if request.POST.get('select_across') == '1':
+            selection = {
+                'query': base64.b64encode(pickle.dumps(queryset.query)),
+            }
+        else:
+            selection = {
+                'pks': request.POST.getlist(admin.ACTION_CHECKBOX_NAME),
+            }
+        now = time.time()
+        for key in request.session.keys():
+            # drop expired selections of other models too
+            if key.startswith(SELECTION_SESSION_KEY_PREFIX) and (
+                    request.session[key].get('expires', 0) < now):
+                del request.session[key]
+        selection['token'] = uuid.uuid4().hex
+        selection['expires'] = now + self.batch_update_selection_timeout
+        request.session[self._get_selection_session_key()] = selection
+        return selection['token']
+
+    def get_batch_update_selection(self, request):
+        selection = None
+        if 'selection' in request.GET:
+            selection = request.session.get(self._get_selection_session_key())
+            if selection and (
+                    selection['token'] != request.GET['selection'] or
+                    selection['expires'] < time.time()):
+                selection = None
+        elif 'ids' in request.GET:
+            selection = {'pks': request.GET['ids'].split(',')}
+        if selection is None:
+            raise http.Http404
+        return selection
+
+    def get_batch_update_queryset(self, request, selection):
+        queryset = self.get_queryset(request)
+        if 'query' in selection:
+            queryset.query = pickle.loads(base64.b64decode(selection['query']))
+        return queryset
+
+    def get_batch_update_chunks(self, request, selection):
+        """
+        Yields the selection as querysets of at most
+        `batch_update_chunk_size` objects each, in pk order.
+        """
+        queryset = self.get_batch_update_queryset(request, selection)
+        chunk_size = self.batch_update_chunk_size
+        if 'query' in selection:
+            for after, last in iterate_pk_ranges(queryset, chunk_size):
+                yield filter_pk_range(queryset, after, last)
+        else:
+            pks = set()
+            for pk in selection['pks']:
+                try:
+                    pks.add(self.model._meta.pk.to_python(pk))
+                except ValidationError:
+                    pass
+            pks = sorted(pks)
+            for i in xrange(0, len(pks), chunk_size):
+                yield queryset.filter(pk__in=pks[i:i + chunk_size])
+
+    def get_batch_update_count(self, request, selection):
+        if 'query' in selection:
+            return self.get_batch_update_queryset(request, selection).count()
+        return sum(
+            chunk.count()
+            for chunk in self.get_batch_update_chunks(request, selection)
+        )
+
     def get_batch_update_form_class(self, request):
         return self.get_form(
             request,
@@ -142,6 +425,142 @@ class BatchUpdateAdmin(admin.ModelAdmin):
             fields=self.batch_update_fields,
         )
 
+    def batch_update_apply(self, request, form, selection):
+        """ Applies `form` to `selection`; returns the number updated """
+        chunks = self.get_batch_update_chunks(request, selection)
+        if not self.batch_update_chunked:
+            with transaction.atomic(using=self.model._default_manager.db):
+                return form.apply_in_chunks(
+                    request, chunks, save=self.batch_update_save)
+
+        def progress(chunk_count, updated):
+            logger.info(
+                'Batch update of %s: %d chunks, %d objects done',
+                self.model._meta.verbose_name_plural, chunk_count, updated)
+            progress.chunk_count = chunk_count
+            progress.updated = updated
+        progress.chunk_count = progress.updated = 0
+        try:
+            updated = form.apply_in_chunks(
+                request,
+                chunks,
+                save=self.batch_update_save,
+                atomic=True,
+                progress=progress,
+            )
+        except DatabaseError:
+            if progress.updated:
+                # earlier chunks have been committed; say so
+                self.message_user(
+                    request,
+                    ungettext_lazy(
+                        u'%(count)d %(verbose_name)s was updated before '
+                        u'the error (chunks committed: %(chunk_count)d)',
+                        u'%(count)d %(verbose_name_plural)s were updated '
+                        u'before the error (chunks committed: '
+                        u'%(chunk_count)d)',
+                        progress.updated,
+                    ) % {
+                        'count': progress.updated,
+                        'chunk_count': progress.chunk_count,
+                        'verbose_name': self.model._meta.verbose_name,
+                        'verbose_name_plural':
+                            self.model._meta.verbose_name_plural,
+                    },
+                    level=messages.WARNING,
+                )
+            raise
+        # the request only returns when the update is done, so this is the
+        # only progress the user sees
+        self.message_user(
+            request,
+            ungettext_lazy(
+                u'The update was committed in %(chunk_count)d chunk of up '
+                u'to %(chunk_size)d objects',
+                u'The update was committed in %(chunk_count)d chunks of up '
+                u'to %(chunk_size)d objects',
+                progress.chunk_count,
+            ) % {
+                'chunk_count': progress.chunk_count,
+                'chunk_size': self.batch_update_chunk_size,
+            },
+        )
+        return updated
+
+    def get_batch_update_preview(self, request, form, selection, count):
+        """
+        Returns, for each field to be updated, the number of selected objects
+        which would change and the most common of their current values.
+
+        Each field takes one GROUP BY query (per chunk of an explicit
+        selection), so no objects are loaded.
+        """
+        if 'query' in selection:
+            querysets = [self.get_batch_update_queryset(request, selection)]
+        else:
+            querysets = list(self.get_batch_update_chunks(request, selection))
+        update_params, m2m_updates = form.get_updates()
+        preview = []
+
+        for name, value in update_params.iteritems():
+            field = self.model._meta.get_field(name)
+            counts = collections.Counter()
+            for queryset in querysets:
+                for row in queryset.order_by().values(name).annotate(
+                        count=Count('pk')):
+                    counts[row[name]] += row['count']
+            if isinstance(value, models.Model):
+                value = value.pk
+            values = counts.most_common(self.batch_update_preview_values)
+            if field.rel:
+                related = field.rel.to._default_manager.in_bulk(
+                    [pk for pk, n in values if pk is not None])
+                labels = [
+                    force_text(related.get(pk, EMPTY_CHANGELIST_VALUE))
+                    for pk, n in values
+                ]
+            else:
+                labels = [display_for_field(v, field) for v, n in values]
+            preview.append({
+                'label': form.fields[name].label,
+                'changes': count - counts[value],
+                'values': zip(labels, [n for v, n in values]),
+                'other_values': len(counts) - len(values),
+            })
+
+        for action, field, related_objs in m2m_updates:
+            through, source, target = form._get_m2m_through(field)
+            related_pks = set(obj.pk for obj in related_objs)
+            # objects by how many of the related objects they already have
+            counts = collections.Counter()
+            if related_pks:
+                for queryset in querysets:
+                    for row in through._default_manager.filter(**{
+                        '%s__in' % source.name: queryset.values('pk'),
+                        '%s__in' % target.name: related_pks,
+                    }).order_by().values(source.name).annotate(
+                            count=Count(target.name)):
+                        counts[row['count']] += 1
+            counts[0] = count - sum(counts.itervalues())
+            if action == 'add':
+                changes = count - counts[len(related_pks)]
+                field_name = M2M_ADD_PREFIX + field.name
+            else:
+                changes = count - counts[0]
+                field_name = M2M_REMOVE_PREFIX + field.name
+            preview.append({
+                'label': form.fields[field_name].label,
+                'changes': changes,
+                'values': [
+                    (_(u'%(count)d of %(total)d') % {
+                        'count': n, 'total': len(related_pks),
+                    }, counts[n])
+                    for n in sorted(counts) if counts[n]
+                ],
+                'other_values': 0,
+            })
+        return preview
+
     def batch_update_view(self, request):
         template_paths = map(
             lambda path: path % {
@@ -154,12 +573,26 @@ class BatchUpdateAdmin(admin.ModelAdmin):
                 'admin/generic/batch_update.html',
             )
         )
-        ids = request.REQUEST.get('ids', '').split(',')
-        queryset = self.get_queryset(request).filter(pk__in=ids)
+        selection = self.get_batch_update_selection(request)
         form_class = self.get_batch_update_form_class(request)
         form = form_class(request.POST or None)
-        if form.is_valid():
-            updated = form.apply(request, queryset)
+        count = self.get_batch_update_count(request, selection)
+        preview = None
+        if form.is_valid() and '_preview' in request.POST:
+            preview = self.get_batch_update_preview(
+                request, form, selection, count)
+        elif form.is_valid():
+            try:
+                updated = self.batch_update_apply(request, form, selection)
+            except DatabaseError, e:
+                self.message_user(
+                    request,
+                    _(u'Batch update failed: %s') % e,
+                    level=messages.ERROR,
+                )
+                return self.response_post_save_change(request, None)
+            if 'selection' in request.GET:
+                request.session.pop(self._get_selection_session_key(), None)
 
             self.message_user(
                 request,
@@ -189,7 +622,8 @@ class BatchUpdateAdmin(admin.ModelAdmin):
                 'form': form,
                 'model_meta': self.model._meta,
                 'has_change_permission': self.has_change_permission(request),
-                'count': len(queryset),
+                'count': count,
+                'preview': preview,
                 'media': self.media + helpers.AdminForm(
                     form,
                     (), #list(self.get_fieldsets(request)),
@@ -205,7 +639,9 @@ class BatchUpdateAdmin(admin.ModelAdmin):
         return patterns(
             '',
             url(r'^batch-update/$',
-                self.admin_site.admin_view(self.batch_update_view),
+                # transactions are managed by batch_update_apply
+                transaction.non_atomic_requests(
+                    self.admin_site.admin_view(self.batch_update_view)),
                 name=self._get_url_name(
                     'batchupdate', include_namespace=False),
             ),
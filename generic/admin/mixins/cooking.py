@@ -1,12 +1,31 @@
+import hashlib
+import operator
+
 import django
 
 from django import http
 from django.conf import settings
 from django.contrib import admin
-from django.contrib.contenttypes.models import ContentType
-from django.core.exceptions import ImproperlyConfigured
+try:
+    from django.contrib.admin.utils import lookup_needs_distinct, quote
+except ImportError: # django < 1.7
+    from django.contrib.admin.util import lookup_needs_distinct, quote
+try:
+    from django.core.cache import get_cache
+except ImportError:
+    from django.core.cache import caches
+    def get_cache(name):
+        return caches[name]
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db.models import Q, signals
+from django.db.models.fields import FieldDoesNotExist
 from django.forms.widgets import Media, MEDIA_TYPES
 from django.core.urlresolvers import reverse
+from django.utils.cache import patch_cache_control
+from django.utils.encoding import force_text
+from django.utils.http import urlquote
+from ...decorators import _make_safe_cache_key
+from ...utils.querysets import IN_CHUNK_SIZE, iterate_pk_in
 from ..widgets import (
     ForeignKeyCookedIdWidget,
     ManyToManyCookedIdWidget,
@@ -26,6 +45,114 @@ try:
 except ImportError:
     from django.utils import simplejson as json
 
+# stands in for pks in the change URLs of cooked objects
+EDIT_URL_PK_PLACEHOLDER = '__pk__'
+
+
+# (cache name, key prefix) pairs of cached cooked objects, by concrete model
+_cooked_id_caches = {}
+
+def _get_cooked_id_cache_prefix(admin_site, model_admin_class, field_name):
+    return 'generic-cooked-%s-%s.%s-%s' % (
+        admin_site.name,
+        model_admin_class.__module__,
+        model_admin_class.__name__,
+        field_name,
+    )
+
+
+def _get_cooked_id_cache_key(prefix, permission, pk):
+    # pks may be any text, which memcached might not accept
+    return _make_safe_cache_key(
+        u'%s-%s-%s' % (prefix, permission, force_text(pk)), 'cooked')
+
+
+def register_cooked_id_cache(
+        admin_site, model_admin_class, field_name, target_model):
+    """
+    Arranges for cooked representations of `target_model` objects cached by
+    `model_admin_class` to be invalidated when they are saved or deleted,
+    including through proxy models and multi-table inheritance children.
+    """
+    _cooked_id_caches.setdefault(
+        target_model._meta.concrete_model, set()).add((
+            model_admin_class.cooked_id_cache,
+            _get_cooked_id_cache_prefix(
+                admin_site, model_admin_class, field_name),
+        ))
+    for signal in (signals.post_save, signals.post_delete):
+        # for any sender, as subclasses of target_model send their own
+        signal.connect(
+            _invalidate_cooked_ids, dispatch_uid='generic-cooked-ids')
+
+
+def _invalidate_cooked_ids(sender, instance, **kwargs):
+    keys_by_cache = {}
+    for model, caches in _cooked_id_caches.items():
+        if not issubclass(sender, model):
+            continue
+        for cache_name, prefix in caches:
+            keys_by_cache.setdefault(cache_name, []).extend(
+                _get_cooked_id_cache_key(prefix, permission, instance.pk)
+                for permission in ('change', 'view')
+            )
+    for cache_name, keys in keys_by_cache.iteritems():
+        get_cache(cache_name).delete_many(keys)
+
+
+def _get_cooked_model_name(model):
+    """ The name of an inline model in cook-ids-inline URLs """
+    # as for its content type, without looking that up
+    return model._meta.concrete_model._meta.model_name
+
+
+def _get_pk_field(model):
+    """
+    Returns the field which converts pks of `model`; i.e. the field a
+    multi-table inheritance child's parent link relates to, rather than
+    the link itself.
+    """
+    field = model._meta.pk
+    while field.rel:
+        field = field.rel.get_related_field()
+    return field
+
+
+def _stringify_keys(cooked):
+    """ JSON only allows string keys, whatever the type of the pks """
+    return dict((force_text(pk), value) for pk, value in cooked.iteritems())
+
+
+def _json_response(data):
+    content_type_kwarg = (
+        'content_type' if django.VERSION >= (1,7) else 'mimetype'
+    )
+    return http.HttpResponse(
+        json.dumps(data),
+        **{content_type_kwarg: 'application/json'}
+    )
+
+
+def _cacheable_json_response(request, get_data, etag, max_age):
+    """
+    Returns the JSON of `get_data()`, or a 304 if the request's
+    If-None-Match has `etag`. GET responses may be cached for `max_age`.
+    """
+    if request.method != 'GET':
+        return _json_response(get_data())
+    if etag and etag in [
+            value.strip() for value in
+            request.META.get('HTTP_IF_NONE_MATCH', '').split(',')
+    ]:
+        response = http.HttpResponseNotModified()
+    else:
+        response = _json_response(get_data())
+    if etag:
+        response['ETag'] = etag
+    patch_cache_control(response, private=True, max_age=max_age)
+    return response
+
+
 class BaseCookedIdAdmin:
     """
     Support for CookedIdWidgets (vs. RawIdWidgets) in admin.
@@ -36,9 +163,22 @@ class BaseCookedIdAdmin:
 
     Simply list fields in self.cooked_id_widgets instead of self.raw_id_widgets
 
-    Override self.cook() to customise cooked object representations.
+    Override self.cook() to customise cooked object representations, or
+    self.cook_many() to load extra data for them in bulk.
     """
     cooked_id_fields = ()
+    # The name of a cache to keep cooked representations in, if any; they
+    # are invalidated when their objects are saved or deleted, though not
+    # when related objects which their text depends on are
+    cooked_id_cache = None
+    cooked_id_cache_timeout = 60 * 60
+    cooked_id_chunk_size = IN_CHUNK_SIZE
+    # The number of results per page of type-ahead search
+    cooked_id_search_limit = 20
+    # Browsers may reuse cook-ids responses for this many seconds, and
+    # revalidate them by ETag after that if target models have this field
+    cooked_id_max_age = 60
+    cooked_id_modified_field = 'date_modified' # i.e. HousekeepingMixin's
 
     def cook(self, obj, request, field_name):
         """
@@ -50,8 +190,11 @@ class BaseCookedIdAdmin:
         if hasattr(obj, 'get_absolute_url'):
             view_url = obj.get_absolute_url();
 
-        if request.user.has_perm('%s.change_%s' % (obj._meta.app_label, obj._meta.module_name)):
-            edit_url = reverse('admin:%s_%s_change' % (obj._meta.app_label,  obj._meta.module_name),  args=[obj.id])
+        edit_url_template = self.get_cooked_edit_url_template(
+            request, obj.__class__)
+        if edit_url_template:
+            edit_url = edit_url_template.replace(
+                EDIT_URL_PK_PLACEHOLDER, urlquote(quote(obj.pk)))
 
         result = {'text': unicode(obj),
                   'view_url': view_url,
@@ -59,17 +202,54 @@ class BaseCookedIdAdmin:
                   }
         return result
 
-    def cook_ids(self, request, pk, field_name, raw_ids):
-        # TODO: extend to support non-integer/non-`id` PKs
-        if not field_name in self.cooked_id_fields:
-            raise http.Http404
-        try:
-            ids = map(int, raw_ids.split(','))
-        except ValueError:
-            if raw_ids == '':
-                ids = []
+    def cook_many(self, objs, request, field_name):
+        """
+        Returns the cooked representations of `objs`, a list, by pk.
+        Override this to load anything extra that cook() shows for all
+        `objs` at once.
+        """
+        return dict(
+            (obj.pk, self.cook(obj, request=request, field_name=field_name))
+            for obj in objs
+        )
+
+    def get_cooked_edit_url_template(self, request, model):
+        """
+        Returns the admin change URL of `model`, with
+        EDIT_URL_PK_PLACEHOLDER for the pk, or '' if the user can't change
+        it. Worked out once per request rather than for every object.
+        """
+        templates = request.__dict__.setdefault('_cooked_edit_urls', {})
+        if not model in templates:
+            opts = model._meta
+            if request.user.has_perm(
+                    '%s.change_%s' % (opts.app_label, opts.model_name)):
+                templates[model] = reverse(
+                    'admin:%s_%s_change' % (opts.app_label, opts.model_name),
+                    args=[EDIT_URL_PK_PLACEHOLDER],
+                )
             else:
-                raise http.Http404
+                templates[model] = ''
+        return templates[model]
+
+    def parse_cooked_ids(self, field_name, raw_ids):
+        """
+        Converts comma-separated `raw_ids` to pks of the model `field_name`
+        relates to
+        """
+        if raw_ids == '':
+            return []
+        pk_field = _get_pk_field(
+            self.model._meta.get_field(field_name).rel.to)
+        try:
+            return [pk_field.to_python(pk) for pk in raw_ids.split(',')]
+        except ValidationError:
+            raise http.Http404
+
+    def get_cooked_ids(self, request, field_name, ids):
+        """
+        Returns the cooked representations of `ids` for `field_name`, by pk
+        """
         target_model_admin = self.admin_site._registry.get(
             self.model._meta.get_field(field_name).rel.to)
         response_data = {}
@@ -77,20 +257,240 @@ class BaseCookedIdAdmin:
                 target_model_admin and
                 target_model_admin.has_change_permission(request)
         ):
-            for obj in target_model_admin.get_queryset(request).filter(id__in=ids):
-                response_data[obj.pk] = self.cook(
-                    obj, request=request, field_name=field_name)
+            if self.cooked_id_cache:
+                visible_ids = self.get_visible_cooked_ids(
+                    request, target_model_admin, ids)
+                ids = [pk for pk in ids if pk in visible_ids]
+            response_data, ids = self.get_cached_cooked_ids(
+                request, field_name, ids)
+            if ids:
+                cooked = self.cook_many(
+                    list(iterate_pk_in(
+                        target_model_admin.get_queryset(request),
+                        ids,
+                        self.cooked_id_chunk_size,
+                    )),
+                    request=request,
+                    field_name=field_name,
+                )
+                self.cache_cooked_ids(request, field_name, cooked)
+                response_data.update(cooked)
         else:
             pass # graceful-ish.
+        return response_data
+
+    def get_visible_cooked_ids(self, request, target_model_admin, ids):
+        """
+        Returns the set of `ids` which the target admin's queryset includes
+        for this request; cached objects are only used for these, as they
+        may have been cached for users who could see more.
+        """
+        return set(iterate_pk_in(
+            target_model_admin.get_queryset(request).values_list(
+                'pk', flat=True),
+            ids,
+            self.cooked_id_chunk_size,
+        ))
+
+    def get_cooked_id_cache_key(self, request, field_name, pk):
+        target_model = self.model._meta.get_field(field_name).rel.to
+        if self.get_cooked_edit_url_template(request, target_model):
+            permission = 'change'
+        else:
+            permission = 'view'
+        return _get_cooked_id_cache_key(
+            _get_cooked_id_cache_prefix(
+                self.admin_site, self.__class__, field_name),
+            permission,
+            pk,
+        )
 
-        content_type_kwarg = (
-            'content_type' if django.VERSION >= (1,7) else 'mimetype'
+    def get_cached_cooked_ids(self, request, field_name, ids):
+        """
+        Returns the cooked representations of `ids` found in the cache, by
+        pk, and a list of the ids which weren't.
+        """
+        if not self.cooked_id_cache:
+            return {}, list(ids)
+        keys = dict(
+            (self.get_cooked_id_cache_key(request, field_name, pk), pk)
+            for pk in ids
         )
-        return http.HttpResponse(
-            json.dumps(response_data),
-            **{content_type_kwarg: 'application/json'}
+        cached = get_cache(self.cooked_id_cache).get_many(keys.keys())
+        cooked = dict((keys[key], value) for key, value in cached.iteritems())
+        return cooked, [pk for pk in ids if not pk in cooked]
+
+    def cache_cooked_ids(self, request, field_name, cooked):
+        if self.cooked_id_cache:
+            get_cache(self.cooked_id_cache).set_many(
+                dict(
+                    (self.get_cooked_id_cache_key(
+                        request, field_name, pk), value)
+                    for pk, value in cooked.iteritems()
+                ),
+                self.cooked_id_cache_timeout,
+            )
+
+    def cook_ids(self, request, pk, field_name, raw_ids=None):
+        """
+        Returns the cooked representations of ids, which may be POSTed as
+        `ids` rather than being part of the URL, e.g. if there are many.
+        """
+        if not field_name in self.cooked_id_fields:
+            raise http.Http404
+        if raw_ids is None:
+            raw_ids = request.POST.get('ids', '')
+        ids = self.parse_cooked_ids(field_name, raw_ids)
+        etag = None
+        if request.method == 'GET':
+            etag = self.get_cooked_ids_etag(request, field_name, ids)
+        return _cacheable_json_response(
+            request,
+            lambda: _stringify_keys(
+                self.get_cooked_ids(request, field_name, ids)),
+            etag,
+            self.cooked_id_max_age,
         )
 
+    def get_cooked_ids_etag(self, request, field_name, ids):
+        """
+        Returns a weak ETag for the cooked representations of `ids`, from
+        their pks and modification times, or None if the target model has
+        no cooked_id_modified_field (the pks alone wouldn't change when
+        the objects do).
+        """
+        target_model = self.model._meta.get_field(field_name).rel.to
+        target_model_admin = self.admin_site._registry.get(target_model)
+        modified_field = self.cooked_id_modified_field
+        if not modified_field:
+            return None
+        try:
+            target_model._meta.get_field(modified_field)
+        except FieldDoesNotExist:
+            return None
+        if not (
+                target_model_admin and
+                target_model_admin.has_change_permission(request)
+        ):
+            return None
+        rows = []
+        pks = list(ids)
+        queryset = target_model_admin.get_queryset(request).values_list(
+            'pk', modified_field)
+        for i in xrange(0, len(pks), self.cooked_id_chunk_size):
+            rows.extend(queryset.filter(
+                pk__in=pks[i:i + self.cooked_id_chunk_size]))
+        return 'W/"%s"' % hashlib.md5(repr((
+            field_name,
+            bool(self.get_cooked_edit_url_template(request, target_model)),
+            pks,
+            sorted(rows),
+        ))).hexdigest()
+
+    def get_cooked_id_search_lookups(self, target_model_admin):
+        """
+        Returns lookups for the target admin's search_fields which match the
+        start of values, and so can use indexes (on the upper-cased column
+        for case-insensitive matching in PostgreSQL).
+        """
+        lookups = []
+        for search_field in target_model_admin.search_fields:
+            if search_field.startswith('='):
+                lookups.append('%s__iexact' % search_field[1:])
+            elif search_field.startswith(('^', '@')):
+                lookups.append('%s__istartswith' % search_field[1:])
+            else:
+                lookups.append('%s__istartswith' % search_field)
+        return lookups
+
+    def search_cooked_ids(self, request, field_name, query, after=None):
+        """
+        Returns up to cooked_id_search_limit (pk, cooked object) pairs for
+        objects `field_name` can relate to which start with `query`, in pk
+        order, and whether there are more after them.
+        """
+        target_model_admin = self.admin_site._registry.get(
+            self.model._meta.get_field(field_name).rel.to)
+        if not (
+                target_model_admin and
+                target_model_admin.has_change_permission(request)
+        ):
+            return [], False
+        lookups = self.get_cooked_id_search_lookups(target_model_admin)
+        if not (query and lookups):
+            return [], False
+        queryset = target_model_admin.get_queryset(request).filter(
+            reduce(
+                operator.or_,
+                [Q(**{lookup: query}) for lookup in lookups],
+            )
+        ).order_by('pk')
+        if any(
+                lookup_needs_distinct(target_model_admin.model._meta, lookup)
+                for lookup in lookups
+        ):
+            queryset = queryset.distinct()
+        if after is not None:
+            queryset = queryset.filter(pk__gt=after)
+        # keyset pagination, so later pages are as cheap as the first
+        objs = list(queryset[:self.cooked_id_search_limit + 1])
+        more = len(objs) > self.cooked_id_search_limit
+        objs = objs[:self.cooked_id_search_limit]
+        cooked = self.cook_many(objs, request=request, field_name=field_name)
+        return [(obj.pk, cooked[obj.pk]) for obj in objs], more
+
+    def cook_ids_search(self, request, pk, field_name):
+        """
+        Type-ahead search for cooked id widgets; GET `q`, and `after` (the
+        `next` of the previous response) for subsequent pages.
+        """
+        if not field_name in self.cooked_id_fields:
+            raise http.Http404
+        after = request.GET.get('after')
+        if after:
+            try:
+                after = _get_pk_field(self.model._meta.get_field(
+                    field_name).rel.to).to_python(after)
+            except ValidationError:
+                raise http.Http404
+        else:
+            after = None
+        results, more = self.search_cooked_ids(
+            request, field_name, request.GET.get('q', '').strip(), after)
+        return _json_response({
+            'results': [
+                [force_text(result_pk), cooked]
+                for result_pk, cooked in results
+            ],
+            'next': force_text(results[-1][0]) if more else None,
+        })
+
+    def get_cooked_widget_values(self, form):
+        """
+        Yields (field name, widget, ids) for each cooked id field in `form`
+        """
+        for field_name in self.cooked_id_fields:
+            if not field_name in form.fields:
+                continue
+            widget = form.fields[field_name].widget
+            while not isinstance(widget, ForeignKeyCookedIdWidget):
+                widget = getattr(widget, 'widget', None) # i.e. unwrap
+                if widget is None:
+                    break
+            else:
+                value = form[field_name].value()
+                if value in (None, ''):
+                    raw_ids = ''
+                elif isinstance(value, (list, tuple)):
+                    raw_ids = ','.join(map(unicode, value))
+                else:
+                    raw_ids = unicode(value)
+                try:
+                    yield field_name, widget, self.parse_cooked_ids(
+                        field_name, raw_ids)
+                except http.Http404:
+                    pass # invalid data; left for the browser to request
+
     def assert_cooked_target_admin(self, db_field):
         if db_field.rel.to in self.admin_site._registry:
             return True
@@ -109,41 +509,266 @@ class BaseCookedIdAdmin:
 
 
 class CookedIdAdmin(BaseCookedIdAdmin, admin.ModelAdmin):
+    _cooked_id_inlines = None
+
+    def __init__(self, model, admin_site):
+        super(CookedIdAdmin, self).__init__(model, admin_site)
+        # Inline instances only exist during requests, so their caches are
+        # registered here, so that every process invalidates them
+        for model_admin_class in [self.__class__] + list(self.inlines):
+            if getattr(model_admin_class, 'cooked_id_cache', None):
+                if model_admin_class is self.__class__:
+                    model = self.model
+                else:
+                    model = model_admin_class.model
+                for field_name in model_admin_class.cooked_id_fields:
+                    register_cooked_id_cache(
+                        admin_site,
+                        model_admin_class,
+                        field_name,
+                        model._meta.get_field(field_name).rel.to,
+                    )
+
+    def get_cook_ids_inline(self, request, model_name, field_name):
+        """
+        Returns the inline instance which cooks `field_name` of the inline
+        model `model_name`, or None.
+        """
+        inline_class = self.get_cooked_id_inlines().get(
+            (model_name, field_name))
+        if inline_class is None:
+            return None
+        inline = inline_class(self.model, self.admin_site)
+        # as filtered by get_inline_instances()
+        if (
+                inline.has_add_permission(request) or
+                inline.has_change_permission(request) or
+                inline.has_delete_permission(request)
+        ):
+            return inline
+
+    def get_cooked_id_inlines(self):
+        """
+        Returns the inline classes with cooked id fields, by (model name,
+        field name), so that cook requests needn't search every inline.
+        Built once, along with the URLs.
+        """
+        if self._cooked_id_inlines is None:
+            self._cooked_id_inlines = {}
+            for inline in self.inlines:
+                for field_name in getattr(inline, 'cooked_id_fields', ()):
+                    self._cooked_id_inlines.setdefault(
+                        (_get_cooked_model_name(inline.model), field_name),
+                        inline,
+                    )
+        return self._cooked_id_inlines
 
-    def cook_ids_inline(self, request, pk, model_name, field_name, raw_ids):
+    def cook_ids_inline(
+            self, request, pk, model_name, field_name, raw_ids=None):
 
         # find the correct inline instance and pass control to it's own cook_ids()
-        inlines = self.get_inline_instances(request)
-        for inline in inlines:
-            content_type = ContentType.objects.get_for_model(inline.model)
-            if model_name == content_type.model and field_name in inline.cooked_id_fields:
-                # this is our guy
-                return inline.cook_ids(request, pk, field_name, raw_ids)
+        inline = self.get_cook_ids_inline(request, model_name, field_name)
+        if inline is None:
+            raise http.Http404
+        return inline.cook_ids(request, pk, field_name, raw_ids)
 
-        raise http.Http404
+    def cook_ids_inline_search(self, request, pk, model_name, field_name):
+        inline = self.get_cook_ids_inline(request, model_name, field_name)
+        if inline is None:
+            raise http.Http404
+        return inline.cook_ids_search(request, pk, field_name)
+
+    def cook_ids_batch(self, request, pk):
+        """
+        Cooks the ids of any number of fields, including those of inlines,
+        in one request, so that a change form only needs to make one.
+
+        GET or POST `fields` as a JSON object of
+        `{key: {"field": ..., "ids": "1,2,3", "model": ...}}`, where "model"
+        is the model name of an inline, or omitted for the admin's own
+        fields. The response is `{key: {pk: cooked object}}`. Ids for the
+        same field are merged, so each field takes one query however many
+        inline rows it appears in. Fields which aren't cooked get no
+        objects, and a malformed `fields` gets a 400. GET responses are cacheable as those of
+        `cook_ids` are, with an ETag if every field has one.
+        """
+        if request.method == 'GET':
+            data = request.GET
+        elif request.method == 'POST':
+            data = request.POST
+        else:
+            return http.HttpResponseNotAllowed(['GET', 'POST'])
+        try:
+            fields = json.loads(data.get('fields', ''))
+            if not isinstance(fields, dict):
+                raise ValueError
+        except ValueError:
+            return http.HttpResponseBadRequest()
+
+        model_admins = {}
+        ids_by_field = {}
+        ids_by_key = {}
+        for key, spec in fields.iteritems():
+            if not (
+                    isinstance(spec, dict) and
+                    isinstance(spec.get('field'), basestring) and
+                    isinstance(spec.get('model'), (basestring, type(None))) and
+                    isinstance(spec.get('ids'), basestring)
+            ):
+                return http.HttpResponseBadRequest()
+            field = (spec.get('model') or None, spec['field'])
+            try:
+                if not field in model_admins:
+                    model_name, field_name = field
+                    if model_name is None:
+                        if field_name in self.cooked_id_fields:
+                            model_admins[field] = self
+                        else:
+                            model_admins[field] = None
+                    else:
+                        model_admins[field] = self.get_cook_ids_inline(
+                            request, model_name, field_name)
+                if model_admins[field] is None:
+                    ids = []
+                else:
+                    ids = model_admins[field].parse_cooked_ids(
+                        field[1], spec['ids'])
+            except http.Http404:
+                continue # ignore invalid ids, as for missing objects
+            ids_by_field.setdefault(field, set()).update(ids)
+            ids_by_key[key] = (field, ids)
+
+        etag = None
+        if request.method == 'GET':
+            etags = [
+                (field, model_admins[field].get_cooked_ids_etag(
+                    request, field[1], sorted(ids)))
+                for field, ids in ids_by_field.iteritems()
+                if model_admins[field] is not None
+            ]
+            if all(field_etag for field, field_etag in etags):
+                etag = 'W/"%s"' % hashlib.md5(
+                    repr(sorted(etags))).hexdigest()
+
+        def get_data():
+            cooked_by_field = {}
+            for field, ids in ids_by_field.iteritems():
+                if model_admins[field] is not None:
+                    cooked_by_field[field] = model_admins[
+                        field].get_cooked_ids(request, field[1], ids)
+            response_data = {}
+            for key, (field, ids) in ids_by_key.iteritems():
+                cooked = cooked_by_field.get(field, {})
+                response_data[key] = _stringify_keys(dict(
+                    (pk, cooked[pk]) for pk in ids if pk in cooked))
+            return response_data
+
+        return _cacheable_json_response(
+            request, get_data, etag, self.cooked_id_max_age)
+
+    def precook_forms(self, request, forms):
+        """
+        Cooks the values of the cooked id fields of `forms`, a list of
+        (model admin, form) pairs, for their widgets to render, so that the
+        browser doesn't have to request them. Takes one query per target
+        model, whatever the number of forms and fields.
+        """
+        fields_by_model = {}
+        for model_admin, form in forms:
+            for field_name, widget, ids in (
+                    model_admin.get_cooked_widget_values(form)):
+                target_model = model_admin.model._meta.get_field(
+                    field_name).rel.to
+                fields_by_model.setdefault(target_model, []).append(
+                    (model_admin, field_name, widget, ids))
+
+        for target_model, fields in fields_by_model.iteritems():
+            target_model_admin = self.admin_site._registry.get(target_model)
+            if not (
+                    target_model_admin and
+                    target_model_admin.has_change_permission(request)
+            ):
+                for model_admin, field_name, widget, ids in fields:
+                    widget.cooked = {}
+                continue
+            if any(field[0].cooked_id_cache for field in fields):
+                visible_ids = self.get_visible_cooked_ids(
+                    request,
+                    target_model_admin,
+                    set(pk for _, _, _, ids in fields for pk in ids),
+                )
+                fields = [
+                    (model_admin, field_name, widget, [
+                        pk for pk in ids if pk in visible_ids])
+                    for model_admin, field_name, widget, ids in fields
+                ]
+            missing_ids = set()
+            for model_admin, field_name, widget, ids in fields:
+                widget.cooked, missing = model_admin.get_cached_cooked_ids(
+                    request, field_name, ids)
+                missing_ids.update(missing)
+            objs = dict(
+                (obj.pk, obj) for obj in iterate_pk_in(
+                    target_model_admin.get_queryset(request),
+                    missing_ids,
+                    self.cooked_id_chunk_size,
+                )
+            )
+            for model_admin, field_name, widget, ids in fields:
+                cooked = model_admin.cook_many(
+                    [
+                        objs[pk] for pk in ids
+                        if pk in objs and not pk in widget.cooked
+                    ],
+                    request=request,
+                    field_name=field_name,
+                )
+                model_admin.cache_cooked_ids(request, field_name, cooked)
+                widget.cooked.update(cooked)
+
+    def render_change_form(self, request, context, *args, **kwargs):
+        forms = [(self, context['adminform'].form)]
+        for inline_admin_formset in context.get('inline_admin_formsets', ()):
+            inline = inline_admin_formset.opts
+            if getattr(inline, 'cooked_id_fields', None):
+                forms.extend(
+                    (inline, form)
+                    for form in inline_admin_formset.formset.forms
+                )
+        self.precook_forms(request, forms)
+        return super(CookedIdAdmin, self).render_change_form(
+            request, context, *args, **kwargs)
 
     def get_urls(self):
 
         urlpatterns = patterns(
             '',
-            url(r'^(?P<pk>.+)/cook-ids/(?P<field_name>\w+)/(?P<raw_ids>[\d,]+)/$',
-                self.admin_site.admin_view(self.cook_ids))
+            url(r'^(?P<pk>.+)/cook-ids-batch/$',
+                # caching is up to cook_ids_batch
+                self.admin_site.admin_view(
+                    self.cook_ids_batch, cacheable=True)),
+            url(r'^(?P<pk>.+)/cook-ids-search/(?P<field_name>\w+)/$',
+                self.admin_site.admin_view(self.cook_ids_search)),
+            url(r'^(?P<pk>.+)/cook-ids/(?P<field_name>\w+)/(?:(?P<raw_ids>[^/]+)/)?$',
+                # caching is up to cook_ids
+                self.admin_site.admin_view(self.cook_ids, cacheable=True))
         )
 
         # add any inline cooked ID urls...
 
-        for inline in self.inlines:
-            try:
-                if inline.cooked_id_fields:
-                    content_type = ContentType.objects.get_for_model(inline.model)
-                    urlpatterns += patterns(
-                        '',
-                        url(r'^(?P<pk>.+)/cook-ids-inline/(?P<model_name>'+content_type.model+')/(?P<field_name>\w+)/(?P<raw_ids>[\d,]+)/$',
-                            self.admin_site.admin_view(self.cook_ids_inline))
-                    )
-            except AttributeError:
-                # probably not a TabularInlineCookedIdAdmin
-                pass
+        model_names = set(
+            model_name
+            for model_name, field_name in self.get_cooked_id_inlines()
+        )
+        for model_name in model_names:
+            urlpatterns += patterns(
+                '',
+                url(r'^(?P<pk>.+)/cook-ids-inline-search/(?P<model_name>'+model_name+')/(?P<field_name>\w+)/$',
+                    self.admin_site.admin_view(self.cook_ids_inline_search)),
+                url(r'^(?P<pk>.+)/cook-ids-inline/(?P<model_name>'+model_name+')/(?P<field_name>\w+)/(?:(?P<raw_ids>[^/]+)/)?$',
+                    self.admin_site.admin_view(
+                        self.cook_ids_inline, cacheable=True))
+            )
 
         return urlpatterns + super(CookedIdAdmin, self).get_urls()
 
@@ -169,24 +794,22 @@ class TabularInlineCookedIdAdmin(BaseCookedIdAdmin, admin.TabularInline):
     content_type = None
 
     def formfield_for_manytomany(self, db_field, request=None, **kwargs):
-        content_type = ContentType.objects.get_for_model(self.model)
         if db_field.name in self.cooked_id_fields:
             if self.assert_cooked_target_admin(db_field):
                 kwargs['widget'] = TabularInlineManyToManyCookedIdWidget(
                     db_field.rel, self.admin_site, {
-                        'data-model': content_type.model,
+                        'data-model': _get_cooked_model_name(self.model),
                         'data-field': db_field.name,
                     })
         return super(TabularInlineCookedIdAdmin, self).formfield_for_manytomany(
             db_field, request=request, **kwargs)
 
     def formfield_for_foreignkey(self, db_field, request=None, **kwargs):
-        content_type = ContentType.objects.get_for_model(self.model)
         if db_field.name in self.cooked_id_fields:
             if self.assert_cooked_target_admin(db_field):
                 kwargs['widget'] = TabularInlineForeignKeyCookedIdWidget(
                     db_field.rel, self.admin_site, {
-                        'data-model': content_type.model,
+                        'data-model': _get_cooked_model_name(self.model),
                         'data-field': db_field.name,
                     })
         return super(TabularInlineCookedIdAdmin, self).formfield_for_foreignkey(
@@ -198,24 +821,22 @@ class StackedInlineCookedIdAdmin(BaseCookedIdAdmin, admin.StackedInline):
     content_type = None
 
     def formfield_for_manytomany(self, db_field, request=None, **kwargs):
-        content_type = ContentType.objects.get_for_model(self.model)
         if db_field.name in self.cooked_id_fields:
             if self.assert_cooked_target_admin(db_field):
                 kwargs['widget'] = StackedInlineManyToManyCookedIdWidget(
                     db_field.rel, self.admin_site, {
-                        'data-model': content_type.model,
+                        'data-model': _get_cooked_model_name(self.model),
                         'data-field': db_field.name,
                     })
         return super(StackedInlineCookedIdAdmin, self).formfield_for_manytomany(
             db_field, request=request, **kwargs)
 
     def formfield_for_foreignkey(self, db_field, request=None, **kwargs):
-        content_type = ContentType.objects.get_for_model(self.model)
         if db_field.name in self.cooked_id_fields:
             if self.assert_cooked_target_admin(db_field):
                 kwargs['widget'] = StackedInlineForeignKeyCookedIdWidget(
                     db_field.rel, self.admin_site, {
-                        'data-model': content_type.model,
+                        'data-model': _get_cooked_model_name(self.model),
                         'data-field': db_field.name,
                     })
         return super(StackedInlineCookedIdAdmin, self).formfield_for_foreignkey(
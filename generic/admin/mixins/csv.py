@@ -1,10 +1,555 @@
+import base64
+import collections
+import itertools
+import logging
+import multiprocessing
+import operator
+import os
+import re
+import tempfile
+import time
+import uuid
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
 from django import http
+from django.conf import settings
+try:
+    from django.conf.urls import patterns, url
+except ImportError:
+    from django.conf.urls.defaults import patterns, url
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+try:
+    from django.contrib.auth import get_user_model
+except ImportError:
+    # Django < 1.5
+    from django.contrib.auth.models import User
+    get_user_model = lambda: User
+from django.core import signing
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.exceptions import ImproperlyConfigured, PermissionDenied
+from django.core.servers.basehttp import FileWrapper
+from django.core.urlresolvers import reverse
+from django.db import connections, models
+from django.db.models.fields import FieldDoesNotExist
+try:
+    from django.db.models.fields.subclassing import SubfieldBase
+except ImportError:
+    SubfieldBase = None # django >= 1.10
 from django.template import defaultfilters
+from django.template.response import TemplateResponse
+try:
+    from django.utils.importlib import import_module
+except ImportError:
+    from importlib import import_module
 from django.utils.translation import ugettext_lazy as _
-from ...utils import unicode_csv
+try:
+    from django.apps import apps
+    get_model = apps.get_model
+except ImportError:
+    from django.db.models.loading import get_model
+from ...utils import export_formats, querysets
+
+EXPORT_FORMAT_VAR = '_format'
+
+logger = logging.getLogger(__name__)
+
+# "author.name" and "author__name" are equivalent; "__unicode__" is left alone
+FIELD_PATH_SEPARATOR = re.compile(r'\.|(?<=[^_])__(?=[^_])')
+
+
+def _attribute_getter(names):
+    """ Returns a getter for a path of attributes which tolerates nulls """
+    if len(names) == 1:
+        return operator.attrgetter(names[0])
+    def getter(obj):
+        for name in names:
+            if obj is None:
+                return None
+            obj = getattr(obj, name)
+        return obj
+    return getter
+
+
+class CSVExportPlan(object):
+    """
+    `csv_export_fields` compiled into a row-building plan.
+
+    Columns which are plain (non-relation) model fields, including those
+    reached through foreign keys, are read with a single `values_list()`
+    query. Only when there are callables or other attributes to resolve are
+    model instances loaded, using `select_related` / `prefetch_related`
+    inferred from the field paths plus any declared as attributes of the
+    callables themselves, e.g.
+
+        def author_email(obj):
+            return obj.author.user.email
+        author_email.select_related = ('author__user',)
+    """
+    def __init__(self, model, fields):
+        self.model = model
+        self.titles = []
+        self.value_paths = []
+        self.getters = []
+        self.needs_instances = False
+        self.select_related = set()
+        self.prefetch_related = set()
+        for title, key in fields:
+            self.titles.append(title)
+            if callable(key):
+                self.getters.append(key)
+                self.needs_instances = True
+                self.select_related.update(
+                    getattr(key, 'select_related', ()))
+                self.prefetch_related.update(
+                    getattr(key, 'prefetch_related', ()))
+            else:
+                self._compile_path(key)
+
+    def _compile_path(self, key):
+        names = FIELD_PATH_SEPARATOR.split(key)
+        self.getters.append(_attribute_getter(names))
+        opts = self.model._meta
+        for i, name in enumerate(names):
+            try:
+                field = opts.get_field(name)
+            except FieldDoesNotExist:
+                break # some other attribute
+            related_path = '__'.join(names[:i + 1])
+            if isinstance(field, models.ManyToManyField):
+                self.prefetch_related.add(related_path)
+                break
+            elif field.rel:
+                self.select_related.add(related_path)
+                opts = field.rel.to._meta
+            elif i == len(names) - 1 and not (
+                    SubfieldBase and isinstance(field.__class__, SubfieldBase)
+            ):
+                self.value_paths.append(related_path)
+                return
+            else:
+                break
+        self.needs_instances = True
+
+    def get_queryset(self, queryset):
+        if self.needs_instances:
+            if self.select_related:
+                queryset = queryset.select_related(*self.select_related)
+            if self.prefetch_related:
+                queryset = queryset.prefetch_related(*self.prefetch_related)
+            return queryset
+        else:
+            return queryset.values_list(*self.value_paths)
+
+    def chunks(self, queryset, chunk_size, after=None, offset=0):
+        """
+        Yields a (last_pk, rows) pair for each chunk of at most `chunk_size`
+        results, in the order of `queryset`.
+
+        Querysets ordered by pk (or not at all), or by other non-null fields
+        of the model, are read by keyset pagination, starting after pk
+        `after` if specified; others by LIMIT/OFFSET, starting at `offset`.
+        See `querysets`.
+        """
+        pk_ordering = querysets.get_pk_ordering(queryset)
+        keyset = None
+        if pk_ordering is None:
+            keyset = querysets.get_keyset_ordering(queryset)
+        key_names = [name for name, descending in keyset or ()]
+        if self.needs_instances:
+            queryset = self.get_queryset(queryset)
+            get_pk = operator.attrgetter('pk')
+            getters = self.getters
+            get_row = lambda obj: [getter(obj) for getter in getters]
+            get_key = lambda obj: tuple(
+                getattr(obj, name) for name in key_names)
+        else:
+            # with the keyset fields at the end, to page by
+            queryset = queryset.values_list(
+                'pk', *(list(self.value_paths) + key_names))
+            get_pk = operator.itemgetter(0)
+            end = len(self.value_paths) + 1
+            get_row = lambda values: list(values[1:end])
+            get_key = lambda values: values[end:]
+        after_key = None
+        if keyset is not None and after is not None:
+            after_key = querysets.get_keyset_key(queryset, after)
+        if pk_ordering is not None:
+            chunks = querysets.iterate_in_chunks(
+                queryset, chunk_size, get_pk, after)
+        elif keyset is not None and (after is None or after_key is not None):
+            chunks = querysets.iterate_keyset_chunks(
+                queryset, chunk_size, get_key, after_key)
+        else:
+            # not comparable, or resuming after an object since deleted
+            chunks = querysets.iterate_ordered_chunks(
+                queryset, chunk_size, offset)
+        for chunk in chunks:
+            yield get_pk(chunk[-1]), map(get_row, chunk)
+
+    def rows(self, queryset, chunk_size=None):
+        """
+        Yields a list of values for each result of `queryset`; in chunks of
+        `chunk_size` rather than a single query if specified.
+        """
+        if chunk_size:
+            for last_pk, rows in self.chunks(queryset, chunk_size):
+                for row in rows:
+                    yield row
+        elif self.needs_instances:
+            getters = self.getters
+            for obj in self.get_queryset(queryset):
+                yield [getter(obj) for getter in getters]
+        else:
+            for values in self.get_queryset(queryset):
+                yield list(values)
+
+
+class CSVExportJob(object):
+    """
+    A CSV export run in the background by the `process_csv_exports`
+    management command.
+
+    Jobs are queued as JSON files in settings.GENERIC_CSV_EXPORT_QUEUE_DIR,
+    so no broker is required, and the export is written to `default_storage`
+    one chunk at a time, recording the last pk written so that an
+    interrupted job resumes where it left off.
+
+    As job files name the admin class to import and hold a pickled query,
+    they are signed with SECRET_KEY, and the queue directory must not be
+    writable by other users.
+    """
+    signing_salt = 'generic.admin.mixins.csv.CSVExportJob'
+    PENDING = 'pending'
+    RUNNING = 'running'
+    COMPLETE = 'complete'
+    FAILED = 'failed'
+
+    def __init__(self, **state):
+        self.__dict__.update(state)
+
+    @staticmethod
+    def get_queue_dir():
+        return getattr(
+            settings,
+            'GENERIC_CSV_EXPORT_QUEUE_DIR',
+            os.path.join(tempfile.gettempdir(), 'generic-csv-exports'),
+        )
+
+    @staticmethod
+    def get_storage_dir():
+        return getattr(
+            settings, 'GENERIC_CSV_EXPORT_STORAGE_DIR', 'csv-exports')
+
+    @classmethod
+    def create(cls, model_admin, request, queryset, format_name='csv'):
+        job = cls.build(model_admin, request, queryset, format_name)
+        job.save()
+        return job
+
+    @classmethod
+    def build(cls, model_admin, request, queryset, format_name='csv'):
+        """ Returns a new job without queueing it """
+        export_format = model_admin.get_export_format(request, format_name)
+        return cls(
+            id=uuid.uuid4().hex,
+            status=cls.PENDING,
+            model_admin='%s.%s' % (
+                model_admin.__class__.__module__,
+                model_admin.__class__.__name__,
+            ),
+            app_label=queryset.model._meta.app_label,
+            model_name=queryset.model._meta.model_name,
+            user_id=request.user.pk,
+            query=base64.b64encode(pickle.dumps(queryset.query)),
+            format=format_name,
+            filename=model_admin.get_export_filename(request, export_format),
+            chunk_size=model_admin.csv_export_chunk_size,
+            created=time.time(),
+            total=None,
+            rows_written=0,
+            parts=0,
+            last_pk=None,
+            file=None,
+            error=None,
+        )
+
+    @classmethod
+    def get_path(cls, job_id, extension='json'):
+        return os.path.join(cls.get_queue_dir(), '%s.%s' % (job_id, extension))
+
+    @classmethod
+    def load(cls, job_id):
+        with open(cls.get_path(job_id)) as job_file:
+            data = job_file.read()
+        try:
+            data = signing.Signer(salt=cls.signing_salt).unsign(data)
+        except signing.BadSignature:
+            raise ValueError('CSV export job %s is not signed' % job_id)
+        return cls(**json.loads(data))
+
+    @classmethod
+    def get_runnable_ids(cls):
+        """ Pending jobs, plus running jobs whose worker has died """
+        try:
+            filenames = os.listdir(cls.get_queue_dir())
+        except OSError:
+            return []
+        job_ids = []
+        for filename in sorted(filenames):
+            job_id, extension = os.path.splitext(filename)
+            if extension == '.json' and not cls.is_locked(job_id):
+                try:
+                    job = cls.load(job_id)
+                except (IOError, ValueError):
+                    continue # removed, or being replaced
+                if job.status in (cls.PENDING, cls.RUNNING):
+                    job_ids.append(job_id)
+        return job_ids
+
+    @classmethod
+    def check_queue_dir(cls):
+        """
+        Creates the queue directory if need be, accessible only to this
+        user; refuses to use one which other users could write to.
+        """
+        queue_dir = cls.get_queue_dir()
+        if not os.path.isdir(queue_dir):
+            os.makedirs(queue_dir, 0700)
+        if hasattr(os, 'getuid'):
+            stat = os.stat(queue_dir)
+            if stat.st_uid != os.getuid() or stat.st_mode & 022:
+                raise ImproperlyConfigured(
+                    'The CSV export queue directory %s must be owned by '
+                    'this user, and not writable by others.' % queue_dir)
+
+    def save(self):
+        self.check_queue_dir()
+        path = self.get_path(self.id)
+        with open(path + '.tmp', 'w') as job_file:
+            job_file.write(signing.Signer(salt=self.signing_salt).sign(
+                json.dumps(self.__dict__)))
+        os.rename(path + '.tmp', path) # atomic, so readers never see half
+
+    @classmethod
+    def is_locked(cls, job_id):
+        try:
+            with open(cls.get_path(job_id, 'lock')) as lock_file:
+                pid = int(lock_file.read())
+            os.kill(pid, 0)
+        except (IOError, OSError, ValueError):
+            return False # no lock, or its process is gone
+        return True
+
+    def lock(self):
+        path = self.get_path(self.id, 'lock')
+        if self.is_locked(self.id):
+            return False
+        if os.path.exists(path):
+            os.remove(path) # stale
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            return False # beaten to it
+        os.write(fd, str(os.getpid()))
+        os.close(fd)
+        return True
+
+    def unlock(self):
+        os.remove(self.get_path(self.id, 'lock'))
+
+    def get_part_name(self, part):
+        return '%s/%s/%05d.part' % (self.get_storage_dir(), self.id, part)
+
+    def get_model_admin(self):
+        module_name, class_name = self.model_admin.rsplit('.', 1)
+        model_admin_class = getattr(import_module(module_name), class_name)
+        return model_admin_class(
+            get_model(self.app_label, self.model_name), admin.site)
+
+    def get_request(self):
+        request = http.HttpRequest()
+        request.user = get_user_model()._default_manager.get(pk=self.user_id)
+        return request
+
+    def get_queryset(self, model_admin):
+        queryset = model_admin.model._default_manager.all()
+        queryset.query = pickle.loads(base64.b64decode(self.query))
+        return queryset
+
+    def run(self):
+        """
+        Writes any remaining chunks, then stitches them into the final file
+        """
+        try:
+            model_admin = self.get_model_admin()
+            request = self.get_request()
+            queryset = self.get_queryset(model_admin)
+            plan = model_admin.get_csv_export_plan(request)
+            export_format = model_admin.get_export_format(request, self.format)
+            self.status = self.RUNNING
+            if self.total is None:
+                self.total = queryset.count()
+            self.save()
+
+            for last_pk, rows in plan.chunks(
+                    queryset,
+                    self.chunk_size,
+                    after=self.last_pk,
+                    offset=self.rows_written,
+            ):
+                self.write_part(export_format.encode_rows(rows))
+                self.rows_written += len(rows)
+                self.last_pk = last_pk
+                self.save()
+
+            self.file = self.stitch_parts(export_format)
+            self.status = self.COMPLETE
+        except Exception, e:
+            logger.exception('CSV export job %s failed', self.id)
+            self.status = self.FAILED
+            self.error = unicode(e)
+        self.save()
+
+    def write_part(self, data):
+        name = self.get_part_name(self.parts)
+        if default_storage.exists(name):
+            default_storage.delete(name) # left by an interrupted run
+        default_storage.save(name, ContentFile(data))
+        self.parts += 1
+
+    def read_parts(self):
+        for part in range(self.parts):
+            with default_storage.open(self.get_part_name(part)) as f:
+                for data in iter(lambda: f.read(64 * 1024), ''):
+                    yield data
+
+    def stitch_parts(self, export_format):
+        with tempfile.TemporaryFile() as output:
+            for data in export_format.serialize_encoded(self.read_parts()):
+                output.write(data)
+            output.seek(0)
+            name = default_storage.save(
+                '%s/%s/%s' % (self.get_storage_dir(), self.id, self.filename),
+                File(output),
+            )
+        for part in range(self.parts):
+            default_storage.delete(self.get_part_name(part))
+        return name
+
+    def get_progress(self):
+        """ Percentage complete, or None if not yet known """
+        if self.status == self.COMPLETE:
+            return 100
+        if self.total:
+            return min(99, 100 * self.rows_written // self.total)
+
+
+def run_csv_export_job(job_id):
+    """ Runs a job if no other process is; for use in a process pool """
+    job = CSVExportJob.load(job_id)
+    if job.lock():
+        try:
+            job.run()
+        finally:
+            job.unlock()
+            for connection in connections.all():
+                connection.close()
+
+
+_worker_job = {}
+_inherited_connections = []
+
+def _init_csv_export_worker(job_state):
+    """
+    Process pool initializer for `CSVExportAdmin.csv_export_parallel`.
+
+    The forked worker must neither use nor close the database connections
+    it inherited (closing them would also end the parent's sessions), so
+    references are kept to stop them being garbage collected and Django
+    is left to open new ones.
+    """
+    for connection in connections.all():
+        if connection.connection is not None:
+            _inherited_connections.append(connection.connection)
+            connection.connection = None
+    job = CSVExportJob(**job_state)
+    model_admin = job.get_model_admin()
+    request = job.get_request()
+    _worker_job.update(
+        job=job,
+        queryset=job.get_queryset(model_admin),
+        plan=model_admin.get_csv_export_plan(request),
+        format=model_admin.get_export_format(request, job.format),
+    )
+
+
+def _format_csv_export_range(after, last):
+    """ Returns the encoded rows for one pk range of the worker's job """
+    encode_rows = _worker_job['format'].encode_rows
+    return ''.join(
+        encode_rows(rows) for last_pk, rows in _worker_job['plan'].chunks(
+            querysets.filter_pk_range(_worker_job['queryset'], after, last),
+            _worker_job['job'].chunk_size,
+        )
+    )
+
+
+def _format_csv_export_keyset_range(after, last):
+    """ Returns the encoded rows for one keyset range of the worker's job """
+    encode_rows = _worker_job['format'].encode_rows
+    return ''.join(
+        encode_rows(rows) for last_pk, rows in _worker_job['plan'].chunks(
+            querysets.filter_keyset_range(
+                _worker_job['queryset'], after, last),
+            _worker_job['job'].chunk_size,
+        )
+    )
+
+
+def _format_csv_export_chunk(offset):
+    """ Returns the encoded rows of the chunk at `offset` in the job """
+    for last_pk, rows in _worker_job['plan'].chunks(
+            _worker_job['queryset'], _worker_job['job'].chunk_size,
+            offset=offset):
+        return _worker_job['format'].encode_rows(rows)
+    return ''
+
+
+def _export_action(format_name):
+    def export_action(model_admin, request, queryset):
+        return model_admin.export(request, queryset, format_name)
+    return export_action
+
 
 class CSVExportAdmin(admin.ModelAdmin):
+    change_list_template = 'admin/generic/csv_change_list.html'
+
+    # Stream exports (Django >= 1.5) rather than building the whole file in
+    # memory; rows are fetched `csv_export_chunk_size` at a time, in the
+    # queryset's order: by keyset pagination if that's by pk (or none) or
+    # other non-null fields of the model, or by LIMIT/OFFSET, which gets
+    # slower towards the end, otherwise (e.g. for nullable fields).
+    csv_export_streaming = False
+    csv_export_chunk_size = 1000
+    # Queue exports as CSVExportJobs for the `process_csv_exports` command,
+    # with a status page to download the file from once written.
+    csv_export_background = False
+    # Format pk ranges of `csv_export_chunk_size` rows in a pool of this many
+    # processes, for exports which are CPU-bound on formatting.
+    csv_export_workers = 1
+    # Any of generic.utils.export_formats.FORMATS; each gets its own action.
+    csv_export_formats = ('csv',)
+
     def _get_url_name(self, view_name, include_namespace=True):
         return '%s%s_%s_%s' % (
             'admin:' if include_namespace else '',
@@ -14,35 +559,304 @@ class CSVExportAdmin(admin.ModelAdmin):
         )
 
     def csv_export(self, request, queryset):
-        response = http.HttpResponse(content_type='text/csv')
+        return self.export(request, queryset, 'csv')
+
+    def export(self, request, queryset, format_name):
+        """ Exports `queryset` in one of `csv_export_formats` """
+        if self.csv_export_background:
+            job = CSVExportJob.create(self, request, queryset, format_name)
+            return http.HttpResponseRedirect(
+                reverse(
+                    self._get_url_name('csvexport_status'),
+                    args=(job.id,),
+                    current_app=self.admin_site.name,
+                )
+            )
+        export_format = self.get_export_format(request, format_name)
+        if self.csv_export_workers > 1:
+            content = self.csv_export_parallel(
+                request, queryset, export_format)
+        else:
+            content = self.csv_export_stream(request, queryset, export_format)
+        if self.csv_export_streaming:
+            response_class = http.StreamingHttpResponse
+        else:
+            response_class = http.HttpResponse
+        response = response_class(
+            content, content_type=export_format.content_type)
         response['Content-Disposition'] = 'attachment; filename={0}'.format(
-            self.csv_export_filename(request)
+            self.get_export_filename(request, export_format)
         )
-        writer = unicode_csv.Writer(response)
-        fields = self.csv_export_fields(request)
-        writer.writerow([title for title, key in fields])
-        # TODO: detect absence of callables and use efficient .values query
-        for obj in queryset:
-            row = []
-            for title, key in fields:
-                if callable(key):
-                    row.append(key(obj))
+        return response
+
+    def csv_export_row_blocks(self, request, queryset):
+        """
+        Yields lists of up to `csv_export_chunk_size` rows of values.
+        """
+        plan = self.get_csv_export_plan(request)
+        if self.csv_export_streaming:
+            for last_pk, rows in plan.chunks(
+                    queryset, self.csv_export_chunk_size):
+                yield rows
+        else:
+            rows = plan.rows(queryset)
+            while True:
+                block = list(
+                    itertools.islice(rows, self.csv_export_chunk_size))
+                if not block:
+                    break
+                yield block
+
+    def csv_export_stream(self, request, queryset, export_format=None):
+        """
+        Yields encoded data; the header straight away, then one block per
+        `csv_export_chunk_size` rows.
+        """
+        if export_format is None:
+            export_format = self.get_export_format(request, 'csv')
+        return export_format.serialize(
+            self.csv_export_row_blocks(request, queryset))
+
+    def csv_export_parallel(self, request, queryset, export_format=None):
+        """
+        Yields encoded data like `csv_export_stream`, but with the rows
+        split into ranges (of pks or other keyset fields, or offsets if the
+        queryset's ordering can't be paged by keyset) which are encoded by a
+        pool of `csv_export_workers` processes and yielded in order.
+        """
+        if export_format is None:
+            export_format = self.get_export_format(request, 'csv')
+        job = CSVExportJob.build(self, request, queryset, export_format.name)
+        def encoded_blocks():
+            pool = multiprocessing.Pool(
+                self.csv_export_workers,
+                _init_csv_export_worker,
+                (job.__dict__,),
+            )
+            try:
+                # limit the results held in memory awaiting a slow consumer
+                pending = collections.deque()
+                if querysets.get_pk_ordering(queryset) is not None:
+                    tasks = (
+                        (_format_csv_export_range, pk_range)
+                        for pk_range in querysets.iterate_pk_ranges(
+                            queryset, self.csv_export_chunk_size)
+                    )
+                elif querysets.get_keyset_ordering(queryset) is not None:
+                    tasks = (
+                        (_format_csv_export_keyset_range, key_range)
+                        for key_range in querysets.iterate_keyset_ranges(
+                            queryset, self.csv_export_chunk_size)
+                    )
                 else:
-                    row.append(getattr(obj, key))
-            writer.writerow(row)
+                    tasks = (
+                        (_format_csv_export_chunk, (offset,))
+                        for offset in xrange(
+                            0, queryset.count(), self.csv_export_chunk_size)
+                    )
+                for func, args in tasks:
+                    pending.append(pool.apply_async(func, args))
+                    if len(pending) >= self.csv_export_workers * 2:
+                        yield pending.popleft().get()
+                while pending:
+                    yield pending.popleft().get()
+            finally:
+                pool.terminate()
+                pool.join()
+        return export_format.serialize_encoded(encoded_blocks())
+
+    def csv_export_to_file(self, request, queryset, f, format_name='csv'):
+        """ Writes a complete export to file-like object `f` """
+        export_format = self.get_export_format(request, format_name)
+        if self.csv_export_workers > 1:
+            blocks = self.csv_export_parallel(
+                request, queryset, export_format)
+        else:
+            blocks = self.csv_export_stream(request, queryset, export_format)
+        for block in blocks:
+            f.write(block)
+
+    def get_csv_export_changelist_queryset(self, request):
+        """
+        Rebuilds the change list's queryset from the filters, search and
+        ordering in request.GET, without running its count/page queries.
+        """
+        ChangeList = self.get_changelist(request)
+        QuerysetOnlyChangeList = type(
+            'QuerysetOnlyChangeList',
+            (ChangeList,),
+            {'get_results': lambda self, request: None},
+        )
+        list_display = self.get_list_display(request)
+        if hasattr(self, 'get_list_display_links'):
+            list_display_links = self.get_list_display_links(
+                request, list_display)
+        else:
+            list_display_links = self.list_display_links # django < 1.7
+        if hasattr(self, 'get_search_fields'):
+            search_fields = self.get_search_fields(request)
+        else:
+            search_fields = self.search_fields # django < 1.7
+        if self.get_actions(request):
+            # as in changelist_view, so that the column numbers the change
+            # list is ordered by refer to the same columns here
+            list_display = ['action_checkbox'] + list(list_display)
+        changelist = QuerysetOnlyChangeList(
+            request,
+            self.model,
+            list_display,
+            list_display_links,
+            self.get_list_filter(request),
+            self.date_hierarchy,
+            search_fields,
+            self.list_select_related,
+            self.list_per_page,
+            self.list_max_show_all,
+            self.list_editable,
+            self,
+        )
+        return changelist.queryset
+
+    def csv_export_view(self, request):
+        """
+        Exports everything matching the change list's current filters, with
+        no selection required.
+        """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        if not self.csv_export_enabled(request):
+            raise http.Http404
+        # not a filter, so hide it from the change list
+        request.GET = request.GET.copy()
+        format_name = request.GET.pop(EXPORT_FORMAT_VAR, ['csv'])[0]
+        if not format_name in self.csv_export_formats:
+            raise http.Http404
+        try:
+            queryset = self.get_csv_export_changelist_queryset(request)
+        except IncorrectLookupParameters:
+            raise http.Http404
+        return self.export(request, queryset, format_name)
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        extra_context.setdefault(
+            'csv_export_enabled', self.csv_export_enabled(request))
+        extra_context.setdefault(
+            'csv_export_formats', [
+                {
+                    'name': format_name,
+                    'label': export_formats.FORMATS[format_name].label,
+                } for format_name in self.csv_export_formats
+            ]
+        )
+        extra_context.setdefault('csv_export_format_var', EXPORT_FORMAT_VAR)
+        return super(CSVExportAdmin, self).changelist_view(
+            request, extra_context)
+
+    def get_csv_export_job(self, request, job_id):
+        try:
+            job = CSVExportJob.load(job_id)
+        except (IOError, ValueError):
+            raise http.Http404
+        if (
+                job.user_id != request.user.pk and
+                not request.user.is_superuser
+        ) or (job.app_label, job.model_name) != (
+                self.model._meta.app_label, self.model._meta.model_name):
+            raise http.Http404
+        return job
+
+    def csv_export_status_view(self, request, job_id):
+        job = self.get_csv_export_job(request, job_id)
+        template_paths = map(
+            lambda path: path % {
+                'app_label': self.model._meta.app_label,
+                'model_name': self.model._meta.model_name,
+            }, (
+                'admin/%(app_label)s/%(model_name)s/csv_export_status.html',
+                'admin/%(app_label)s/csv_export_status.html',
+                'admin/csv_export_status.html',
+                'admin/generic/csv_export_status.html',
+            )
+        )
+        return TemplateResponse(
+            request,
+            template_paths, {
+                'job': job,
+                'progress': job.get_progress(),
+                'model_meta': self.model._meta,
+                'has_change_permission': self.has_change_permission(request),
+            },
+            current_app=self.admin_site.name,
+        )
+
+    def csv_export_download_view(self, request, job_id):
+        job = self.get_csv_export_job(request, job_id)
+        if job.status != job.COMPLETE:
+            raise http.Http404
+        response = http.StreamingHttpResponse(
+            FileWrapper(default_storage.open(job.file)),
+            content_type=export_formats.FORMATS[job.format].content_type,
+        )
+        response['Content-Disposition'] = 'attachment; filename={0}'.format(
+            job.filename)
         return response
 
+    def get_urls(self):
+        return patterns(
+            '',
+            url(r'^csv-export/$',
+                self.admin_site.admin_view(self.csv_export_view),
+                name=self._get_url_name(
+                    'csvexport', include_namespace=False),
+            ),
+            url(r'^csv-export/(?P<job_id>[0-9a-f]{32})/$',
+                self.admin_site.admin_view(self.csv_export_status_view),
+                name=self._get_url_name(
+                    'csvexport_status', include_namespace=False),
+            ),
+            url(r'^csv-export/(?P<job_id>[0-9a-f]{32})/download/$',
+                self.admin_site.admin_view(self.csv_export_download_view),
+                name=self._get_url_name(
+                    'csvexport_download', include_namespace=False),
+            ),
+        ) + super(CSVExportAdmin, self).get_urls()
+
     def get_actions(self, request):
         actions = super(CSVExportAdmin, self).get_actions(request)
-        if self.csv_export_enabled(request):
-            if not 'csv_export' in actions:
-                actions['csv_export'] = self.get_action('csv_export')
-        else:
-            if 'csv_export' in actions:
-                del actions['csv_export']
+        export_actions = self.get_export_actions(request)
+        for name, action in export_actions.iteritems():
+            if self.csv_export_enabled(request) and action:
+                if not name in actions:
+                    actions[name] = action
+            else:
+                if name in actions:
+                    del actions[name]
         return actions
     csv_export.short_description = _('Export selected items in CSV format')
 
+    def get_export_actions(self, request):
+        """
+        Returns a dict of export action name => action (or None if the
+        action's format isn't enabled) for every export format.
+        """
+        actions = {}
+        for format_name, format_class in export_formats.FORMATS.iteritems():
+            enabled = format_name in self.csv_export_formats
+            if format_name == 'csv':
+                name = 'csv_export'
+                action = self.get_action(name) if enabled else None
+            else:
+                name = 'csv_export_%s' % format_name.replace('.', '_')
+                action = enabled and (
+                    _export_action(format_name),
+                    name,
+                    _('Export selected items in %s format') % (
+                        format_class.label,),
+                )
+            actions[name] = action or None
+        return actions
+
     def csv_export_enabled(self, request):
         return bool(self.csv_export_fields(request))
 
@@ -51,14 +865,28 @@ class CSVExportAdmin(admin.ModelAdmin):
         This returns a list of two-tuples describing the fields to export.
         The first element of each tuple is the label for the column.
         The second element is a field name or callable which will return the
-        appropriate value for the field given a model instance.
+        appropriate value for the field given a model instance. Field names
+        may follow foreign keys, e.g. "author.name" or "author__name".
         """
         fields = []
         for field in self.model._meta.fields:
             fields.append((field.verbose_name, field.name))
         return fields
 
+    def get_csv_export_plan(self, request):
+        return CSVExportPlan(self.model, self.csv_export_fields(request))
+
+    def get_export_format(self, request, format_name):
+        return export_formats.FORMATS[format_name](
+            self.get_csv_export_plan(request).titles)
+
     def csv_export_filename(self, request):
         return '{0}.csv'.format(
             defaultfilters.slugify(self.model._meta.verbose_name_plural)
         )
+
+    def get_export_filename(self, request, export_format):
+        return '{0}.{1}'.format(
+            os.path.splitext(self.csv_export_filename(request))[0],
+            export_format.extension,
+        )
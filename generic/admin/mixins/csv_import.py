@@ -0,0 +1,316 @@
+import itertools
+
+from django import forms
+try:
+    from django.conf.urls import patterns, url
+except ImportError:
+    from django.conf.urls.defaults import patterns, url
+from django.contrib import admin
+from django.contrib.admin import helpers
+from django.core.exceptions import NON_FIELD_ERRORS, PermissionDenied
+from django.db import DatabaseError, transaction
+from django.template.response import TemplateResponse
+from django.utils.datastructures import SortedDict
+from django.utils.translation import ugettext_lazy as _
+from ...utils import unicode_csv
+from ...utils.querysets import IN_CHUNK_SIZE, bulk_update, iterate_in
+
+
+class CSVImportForm(forms.Form):
+    file = forms.FileField(label=_('CSV file'))
+
+
+class CSVImportResult(object):
+    """ Counts of rows imported, and errors by CSV row number """
+    max_errors = 100
+
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.error_count = 0
+        self.errors = []
+
+    def add_error(self, row, errors):
+        self.error_count += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append((row, errors))
+
+    @property
+    def errors_truncated(self):
+        return self.error_count > len(self.errors)
+
+
+def _cached_to_python(field, cache):
+    """
+    Wraps a ModelChoiceField's to_python to use objects already fetched for
+    the whole batch rather than querying for each row.
+    """
+    to_python = field.to_python
+    def cached_to_python(value):
+        try:
+            return cache[value]
+        except (KeyError, TypeError):
+            return to_python(value)
+    return cached_to_python
+
+
+class CSVImportAdmin(admin.ModelAdmin):
+    """
+    Bulk import of CSV files, the counterpart of CSVExportAdmin.
+
+    Uploads are read as a stream, and rows are validated by the admin's
+    ModelForm (for `csv_import_fields`) and saved in batches of
+    `csv_import_batch_size`, each in its own transaction, with `bulk_create`.
+    If `csv_import_key` names fields which identify existing objects, rows
+    matching one are applied to it instead, with a bulk update. Invalid
+    rows, or those the database rejects, are reported and skipped rather
+    than aborting the import.
+
+    Columns are matched to fields by name or verbose name, so that files
+    from CSVExportAdmin can be imported again. Many-to-many fields are not
+    supported.
+    """
+    change_list_template = 'admin/generic/csv_change_list.html'
+
+    csv_import_fields = ()
+    csv_import_key = ()
+    csv_import_batch_size = 1000
+    csv_import_encoding = 'utf-8-sig' # i.e. tolerate Excel's BOM
+    csv_import_chunk_size = IN_CHUNK_SIZE
+
+    def _get_url_name(self, view_name, include_namespace=True):
+        return '%s%s_%s_%s' % (
+            'admin:' if include_namespace else '',
+            self.model._meta.app_label,
+            self.model._meta.model_name,
+            view_name,
+        )
+
+    def csv_import_enabled(self, request):
+        return bool(self.csv_import_fields) and (
+            self.has_add_permission(request) and (
+                not self.csv_import_key or
+                self.has_change_permission(request)
+            )
+        )
+
+    def get_csv_import_form_class(self, request):
+        form_class = self.get_form(
+            request, obj=None, fields=self.csv_import_fields)
+        # Avoid running queries for every row: uniqueness is left to
+        # csv_import_key and the database, and related objects have already
+        # been found by their form fields, so needn't be checked again by
+        # the model's.
+        choice_field_names = [
+            name for name, field in form_class.base_fields.iteritems()
+            if isinstance(field, forms.ModelChoiceField)
+        ]
+        def _get_validation_exclusions(self):
+            return super(form_class, self)._get_validation_exclusions() + (
+                choice_field_names)
+        return type(
+            form_class.__name__,
+            (form_class,),
+            {
+                'validate_unique': lambda self: None,
+                '_get_validation_exclusions': _get_validation_exclusions,
+            },
+        )
+
+    def get_csv_import_columns(self, header):
+        """
+        Returns the field name for each column of `header`, or None for
+        columns which aren't in `csv_import_fields`.
+        """
+        names = {}
+        for name in self.csv_import_fields:
+            field = self.model._meta.get_field(name)
+            names[name.lower()] = name
+            names[unicode(field.verbose_name).lower()] = name
+        return [names.get(title.strip().lower()) for title in header]
+
+    def csv_import(self, request, f):
+        """ Imports CSV file-like object `f`, returning a CSVImportResult """
+        result = CSVImportResult()
+        reader = unicode_csv.Reader(f, encoding=self.csv_import_encoding)
+        try:
+            columns = self.get_csv_import_columns(next(reader))
+        except StopIteration:
+            return result # empty file
+        form_class = self.get_csv_import_form_class(request)
+        rows = enumerate(reader, 2) # numbered as in a spreadsheet
+        while True:
+            batch = list(itertools.islice(rows, self.csv_import_batch_size))
+            if not batch:
+                break
+            self.csv_import_batch(request, form_class, columns, batch, result)
+        return result
+
+    def csv_import_batch(self, request, form_class, columns, batch, result):
+        data = [
+            (row, dict(
+                (name, value) for name, value in zip(columns, values) if name
+            )) for row, values in batch
+        ]
+        choice_caches = self.get_csv_import_choice_caches(
+            form_class, [row_data for row, row_data in data])
+        valid_forms = []
+        for row, row_data in data:
+            form = form_class(row_data)
+            for name, cache in choice_caches.iteritems():
+                form.fields[name].to_python = _cached_to_python(
+                    form.fields[name], cache)
+            if form.is_valid():
+                valid_forms.append((row, form))
+            else:
+                result.add_error(row, form.errors)
+        if not valid_forms:
+            return
+        try:
+            with transaction.atomic():
+                created, updated = self.csv_import_save(
+                    request,
+                    [form.save(commit=False) for row, form in valid_forms],
+                )
+        except DatabaseError:
+            # find the rows responsible by saving each in a savepoint
+            with transaction.atomic():
+                for row, form in valid_forms:
+                    try:
+                        with transaction.atomic():
+                            created, updated = self.csv_import_save(
+                                request, [form.save(commit=False)])
+                    except DatabaseError, e:
+                        result.add_error(
+                            row, {NON_FIELD_ERRORS: [unicode(e)]})
+                    else:
+                        result.created += created
+                        result.updated += updated
+        else:
+            result.created += created
+            result.updated += updated
+
+    def get_csv_import_choice_caches(self, form_class, data):
+        """
+        Fetches the objects referred to by each ModelChoiceField in a batch
+        with one query per field; returns a dict of dicts by raw value.
+        """
+        caches = {}
+        for name, field in form_class.base_fields.iteritems():
+            if isinstance(field, forms.ModelMultipleChoiceField) or not (
+                    isinstance(field, forms.ModelChoiceField)):
+                continue
+            key = field.to_field_name or 'pk'
+            values = set(
+                row_data[name] for row_data in data if row_data.get(name))
+            cache = {}
+            if values:
+                try:
+                    for obj in iterate_in(
+                            field.queryset, key, values,
+                            self.csv_import_chunk_size):
+                        cache[unicode(getattr(obj, key))] = obj
+                except (ValueError, TypeError):
+                    pass # invalid values; left to the form to report
+            caches[name] = cache
+        return caches
+
+    def csv_import_save(self, request, objs):
+        """
+        Saves a batch of unsaved model instances; returns the numbers of
+        objects created and updated.
+        """
+        manager = self.model._default_manager
+        if not self.csv_import_key:
+            manager.bulk_create(objs)
+            return len(objs), 0
+
+        key_fields = [
+            self.model._meta.get_field(name) for name in self.csv_import_key]
+        get_key = lambda obj: tuple(
+            getattr(obj, field.attname) for field in key_fields)
+        by_key = SortedDict() # the last row for a key wins
+        for obj in objs:
+            by_key[get_key(obj)] = obj
+        existing = dict(
+            (values[:-1], values[-1]) for values in iterate_in(
+                manager.values_list(*(
+                    [field.name for field in key_fields] + ['pk'])),
+                key_fields[0].name,
+                set(key[0] for key in by_key.iterkeys()),
+                self.csv_import_chunk_size,
+            )
+        )
+        update_fields = [
+            field for field in self.model._meta.concrete_fields
+            if field.name in self.csv_import_fields and
+            not field.name in self.csv_import_key
+        ]
+        created = []
+        updated = {}
+        for key, obj in by_key.iteritems():
+            pk = existing.get(key)
+            if pk is None:
+                created.append(obj)
+            else:
+                updated[pk] = obj
+        bulk_update(self.model, updated, update_fields, manager.db)
+        manager.bulk_create(created)
+        return len(created), len(by_key) - len(created)
+
+    def csv_import_view(self, request):
+        if not self.csv_import_enabled(request):
+            raise PermissionDenied
+        template_paths = map(
+            lambda path: path % {
+                'app_label': self.model._meta.app_label,
+                'model_name': self.model._meta.model_name,
+            }, (
+                'admin/%(app_label)s/%(model_name)s/csv_import.html',
+                'admin/%(app_label)s/csv_import.html',
+                'admin/csv_import.html',
+                'admin/generic/csv_import.html',
+            )
+        )
+        form = CSVImportForm(request.POST or None, request.FILES or None)
+        result = None
+        if form.is_valid():
+            result = self.csv_import(request, form.cleaned_data['file'])
+            form = CSVImportForm()
+        return TemplateResponse(
+            request,
+            template_paths, {
+                'form': form,
+                'result': result,
+                'import_fields': [
+                    self.model._meta.get_field(name).verbose_name
+                    for name in self.csv_import_fields
+                ],
+                'import_key': [
+                    self.model._meta.get_field(name).verbose_name
+                    for name in self.csv_import_key
+                ],
+                'model_meta': self.model._meta,
+                'has_change_permission': self.has_change_permission(request),
+                'media': self.media + helpers.AdminForm(
+                    form, (), {}, (), model_admin=self).media,
+            },
+            current_app=self.admin_site.name,
+        )
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        extra_context.setdefault(
+            'csv_import_enabled', self.csv_import_enabled(request))
+        return super(CSVImportAdmin, self).changelist_view(
+            request, extra_context)
+
+    def get_urls(self):
+        return patterns(
+            '',
+            url(r'^csv-import/$',
+                self.admin_site.admin_view(self.csv_import_view),
+                name=self._get_url_name(
+                    'csvimport', include_namespace=False),
+            ),
+        ) + super(CSVImportAdmin, self).get_urls()
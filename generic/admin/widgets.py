@@ -1,11 +1,24 @@
 from django.contrib.admin.widgets import (
      ManyToManyRawIdWidget, ForeignKeyRawIdWidget)
+from django.utils.encoding import force_text
+from django.utils.html import escape
 from django.utils.safestring import mark_safe
 
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
 class ForeignKeyCookedIdWidget(ForeignKeyRawIdWidget):
     """
     For situations where RawIdWidgets are a bit too... well, raw.
+
+    If `cooked` is set to the cooked representations of the value (see
+    `CookedIdAdmin.precook_forms`), they are rendered with the widget
+    rather than requested by the browser.
     """
+    cooked = None
+
     def label_for_value(self, value):
         return '' # avoid displaying normal <strong>value</strong>
 
@@ -14,7 +27,15 @@ class ForeignKeyCookedIdWidget(ForeignKeyRawIdWidget):
             name, value, attrs)
         output = output.replace(
             'RawIdAdminField', 'RawIdAdminField CookedIdField')
-        return mark_safe('<ul class="cooked-data"></ul>' + output)
+        if self.cooked is None:
+            cooked_data = '<ul class="cooked-data"></ul>'
+        else:
+            cooked_data = '<ul class="cooked-data" data-cooked="%s"></ul>' % (
+                escape(json.dumps(dict(
+                    (force_text(pk), cooked)
+                    for pk, cooked in self.cooked.iteritems()
+                ))))
+        return mark_safe(cooked_data + output)
 
     class Media:
         js = ('generic/js/cooked_id_widgets.js', 'generic/js/jquery.contextMenu.js')
@@ -3,7 +3,14 @@ try:
 except ImportError:
     from django.utils import simplejson as json
 
+import cPickle as pickle
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
 from functools import wraps
+from multiprocessing.pool import ThreadPool
 from django.conf import settings
 try:
     from django.core.cache import cache, get_cache
@@ -11,63 +18,566 @@ except ImportError:
     from django.core.cache import cache, caches
     def get_cache(name):
         return caches[name]
+from django.db import connections
+from django.db.models.signals import post_delete, post_save
 from django.http import HttpResponse
+from django.utils.encoding import force_text
 
 import logging
 logger = logging.getLogger(__name__)
 
-def cache_method(cache_name=None):
+# keys which memcached accepts, leaving room for KEY_PREFIX and version
+MAX_CACHE_KEY_LENGTH = 200
+SAFE_CACHE_KEY = re.compile(r'^[\x21-\x7e]*$')
+
+
+def _get_model_label(model):
+    # proxy and deferred classes share their concrete model's results
+    try:
+        model = model._meta.concrete_model
+        return '%s.%s' % (model._meta.app_label, model._meta.model_name)
+    except AttributeError: # not a model
+        return model.__name__
+
+
+def _get_cache_key_part(value):
+    """
+    Returns an unambiguous string for an argument of a cached method; e.g.
+    strings are quoted, so that '1' and 1 or ('a', 'b') and 'a,b' differ,
+    and model instances are represented by their pks.
+    """
+    if isinstance(value, basestring):
+        return json.dumps(force_text(value))
+    elif value is None or isinstance(value, (bool, int, long, float)):
+        return json.dumps(value)
+    elif isinstance(value, (list, tuple)):
+        return '[%s]' % ','.join(map(_get_cache_key_part, value))
+    elif isinstance(value, dict):
+        return '{%s}' % ','.join(sorted(
+            '%s:%s' % (_get_cache_key_part(k), _get_cache_key_part(v))
+            for k, v in value.iteritems()
+        ))
+    elif hasattr(value, '_meta') and not isinstance(value, type):
+        return '<%s:%s>' % (
+            _get_model_label(value.__class__),
+            _get_cache_key_part(value.pk),
+        )
+    return force_text(value)
+
+
+def _make_safe_cache_key(cache_key, name):
+    """
+    Returns `cache_key`, or a digest of it if it would be too long for
+    memcached or contain characters it doesn't allow.
+    """
+    if len(cache_key) > MAX_CACHE_KEY_LENGTH or not (
+            SAFE_CACHE_KEY.match(cache_key)):
+        cache_key = 'generic-%s-%s' % (
+            name, hashlib.sha1(cache_key.encode('utf-8')).hexdigest())
+    return str(cache_key)
+
+
+def _get_cache_method_key(obj, method_name, args, kwargs, generation):
+    cache_key = u'generic-%s-%s-g%s-%s(%s)' % (
+        _get_model_label(obj.__class__),
+        obj.pk,
+        generation,
+        method_name,
+        ','.join(
+            map(_get_cache_key_part, args) + [
+                '%s=%s' % (key, _get_cache_key_part(value))
+                for key, value in sorted(kwargs.iteritems())
+            ]
+        ),
+    )
+    return _make_safe_cache_key(cache_key, method_name)
+
+
+def _prime_cached_method(obj, cache_key, value):
+    """ Keeps `value` in `obj` so that calls for `cache_key` are free """
+    obj.__dict__.setdefault('_cache_method_primed', {})[cache_key] = value
+
+
+def _get_generation_key(model, pk=None):
+    if pk is None:
+        return 'generic-%s-generation' % _get_model_label(model)
+    return _make_safe_cache_key(
+        u'generic-%s-%s-generation' % (_get_model_label(model), pk),
+        'generation',
+    )
+
+
+def _new_generation():
+    # rather than starting from 0, so that if a generation is evicted from
+    # the cache, results from before it was will not be reused
+    return int(time.time() * 1000000)
+
+
+def _load_generations(cache_obj, cache_name, objs, model_wide):
+    """
+    Finds the generation of each of `objs`, as built into the keys of their
+    results in `cache_obj`, and keeps it in the object.
+    """
+    memo_key = (cache_name, model_wide)
+    objs = [
+        obj for obj in objs if not memo_key in
+        obj.__dict__.get('_cache_method_generations', {})
+    ]
+    if not objs:
+        return
+    keys = set(_get_generation_key(obj.__class__, obj.pk) for obj in objs)
+    if model_wide:
+        keys.update(_get_generation_key(obj.__class__) for obj in objs)
+    try:
+        generations = cache_obj.get_many(keys)
+    except Exception, e:
+        logger.warning('Cache error: {0}'.format(e))
+        generations = {}
+    for key in keys:
+        if not key in generations:
+            generation = _new_generation()
+            # generations never expire, or results cached for longer than
+            # the cache's default timeout would be lost along with them
+            if not cache_obj.add(key, generation, None):
+                generation = cache_obj.get(key, generation)
+            generations[key] = generation
+    for obj in objs:
+        generation = '%s' % generations[
+            _get_generation_key(obj.__class__, obj.pk)]
+        if model_wide:
+            generation += '.%s' % generations[
+                _get_generation_key(obj.__class__)]
+        obj.__dict__.setdefault(
+            '_cache_method_generations', {})[memo_key] = generation
+
+
+def _get_generation(cache_obj, cache_name, obj, model_wide):
+    _load_generations(cache_obj, cache_name, [obj], model_wide)
+    return obj._cache_method_generations[(cache_name, model_wide)]
+
+
+_cache_method_infos = {}
+
+def _get_cache_method_info(model):
+    """
+    Returns the names of the caches used by the @cache_method methods of
+    `model`, and of those used by its `model_wide` ones.
+    """
+    try:
+        return _cache_method_infos[model]
+    except KeyError:
+        pass
+    cache_names = set()
+    model_wide_cache_names = set()
+    for cls in model.__mro__:
+        for value in vars(cls).itervalues():
+            if hasattr(value, 'cache_method'):
+                cache_names.add(value.cache_name)
+                if value.cache_model_wide:
+                    model_wide_cache_names.add(value.cache_name)
+    info = _cache_method_infos[model] = (cache_names, model_wide_cache_names)
+    return info
+
+
+def _bump_generation(cache_obj, key):
+    try:
+        cache_obj.incr(key)
+    except ValueError: # not in the cache, so any new generation will do
+        cache_obj.set(key, _new_generation(), None)
+
+
+def invalidate_cached_methods(obj):
+    """
+    Invalidates every @cache_method result for model instance `obj`, by
+    changing the generation built into their keys; or, given a model class,
+    those of its `model_wide` methods for every instance.
+
+    This is done on `post_save` and `post_delete` of models with any such
+    methods.
+    """
+    if isinstance(obj, type):
+        model, pk = obj, None
+        cache_names = _get_cache_method_info(model)[1]
+    else:
+        model, pk = obj.__class__, obj.pk
+        cache_names = _get_cache_method_info(model)[0]
+        obj.__dict__.pop('_cache_method_generations', None)
+        obj.__dict__.pop('_cache_method_primed', None)
+    key = _get_generation_key(model, pk)
+    for cache_name in cache_names:
+        try:
+            _bump_generation(
+                get_cache(cache_name) if cache_name else cache, key)
+        except Exception, e:
+            logger.warning('Cache error: {0}'.format(e))
+
+
+def _invalidate_cached_methods_on_change(sender, instance, **kwargs):
+    cache_names, model_wide_cache_names = _get_cache_method_info(
+        instance.__class__)
+    if cache_names:
+        invalidate_cached_methods(instance)
+    if model_wide_cache_names:
+        invalidate_cached_methods(instance.__class__)
+
+post_save.connect(
+    _invalidate_cached_methods_on_change,
+    dispatch_uid='generic.decorators.invalidate_cached_methods',
+)
+post_delete.connect(
+    _invalidate_cached_methods_on_change,
+    dispatch_uid='generic.decorators.invalidate_cached_methods',
+)
+
+
+class _CachedNone(object):
+    """ Stands for a result of None, which `get` couldn't tell from a miss """
+
+
+class _SoftExpiringValue(object):
+    """ A cached result, with the time after which it should be refreshed """
+    def __init__(self, value, soft_expiry):
+        self.value = value
+        self.soft_expiry = soft_expiry
+
+
+def _pack_cached_value(value, soft_timeout):
+    if soft_timeout is None:
+        return _CachedNone() if value is None else value
+    return _SoftExpiringValue(value, time.time() + soft_timeout)
+
+
+def _unpack_cached_value(cached):
+    """ Returns the result in a cached value, and whether it is stale """
+    if isinstance(cached, _SoftExpiringValue):
+        return cached.value, time.time() > cached.soft_expiry
+    elif isinstance(cached, _CachedNone):
+        return None, False
+    return cached, False
+
+
+_missing = object()
+
+
+class _LocalCache(object):
+    """
+    A thread-safe, least recently used cache of values in this process,
+    bounded by the number of entries and (approximately) their total size.
+    """
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # in order of use
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expiry, value, size = self.entries.pop(key)
+            except KeyError:
+                return default
+            if time.time() > expiry:
+                self.size -= size
+                return default
+            self.entries[key] = (expiry, value, size)
+            return value
+
+    def set(self, key, value, timeout):
+        try:
+            size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        except (pickle.PicklingError, TypeError):
+            return
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[2]
+            self.entries[key] = (time.time() + timeout, value, size)
+            self.size += size
+            while (
+                    len(self.entries) > self.max_entries or
+                    self.size > self.max_bytes):
+                self.size -= self.entries.popitem(last=False)[1][2]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+_local_cache = None
+_local_cache_lock = threading.Lock()
+
+def _get_local_cache():
+    global _local_cache
+    with _local_cache_lock:
+        if _local_cache is None:
+            _local_cache = _LocalCache(
+                getattr(
+                    settings, 'GENERIC_CACHE_METHOD_LOCAL_MAX_ENTRIES', 10000),
+                getattr(
+                    settings, 'GENERIC_CACHE_METHOD_LOCAL_MAX_BYTES',
+                    10 * 1024 * 1024),
+            )
+    return _local_cache
+
+
+def _get_local_result(key):
+    """ Returns a result from the local cache unless stale, or `_missing` """
+    result, stale = _unpack_cached_value(
+        _get_local_cache().get(key, _missing))
+    return _missing if stale else result
+
+
+def _set_cached_value(cache_obj, cache_key, value, timeout):
+    if timeout is None:
+        cache_obj.set(cache_key, value) # i.e. the cache's default timeout
+    else:
+        cache_obj.set(cache_key, value, timeout)
+
+
+def _lock_cached_value(cache_obj, cache_key):
+    """
+    Returns whether this process gets to recompute `cache_key`; `add()` is
+    atomic, so only one can.
+    """
+    return cache_obj.add(
+        cache_key + '-lock',
+        1,
+        getattr(settings, 'GENERIC_CACHE_METHOD_LOCK_TIMEOUT', 60),
+    )
+
+
+def _unlock_cached_value(cache_obj, cache_key):
+    cache_obj.delete(cache_key + '-lock')
+
+
+_refresh_pool = None
+_refresh_pool_lock = threading.Lock()
+
+def _get_refresh_pool():
+    global _refresh_pool
+    with _refresh_pool_lock:
+        if _refresh_pool is None:
+            _refresh_pool = ThreadPool(
+                getattr(settings, 'GENERIC_CACHE_METHOD_REFRESH_THREADS', 2))
+    return _refresh_pool
+
+
+def _refresh_cached_value(
+        method, obj, args, kwargs, cache_obj, cache_key, timeout,
+        soft_timeout):
+    try:
+        result = method(obj, *args, **kwargs)
+        _set_cached_value(
+            cache_obj,
+            cache_key,
+            _pack_cached_value(result, soft_timeout),
+            timeout,
+        )
+        return result
+    finally:
+        _unlock_cached_value(cache_obj, cache_key)
+
+
+def _refresh_cached_value_in_background(*args):
+    try:
+        _refresh_cached_value(*args)
+    except Exception:
+        logger.exception('Error refreshing cached method')
+    finally:
+        # this thread's database connections would otherwise be left open
+        for connection in connections.all():
+            connection.close()
+
+
+def cache_method(
+        cache_name=None, timeout=None, soft_timeout=None,
+        refresh_in_background=False, model_wide=False, local_timeout=None):
     """
     Caches the result of a method for its object instance using the passed
     arguments to generate a cache key
+
+    If `soft_timeout` is given, results are refreshed after that many
+    seconds (rather than when they expire from the cache after `timeout`),
+    and only by whichever process gets there first; others carry on
+    using the stale result meanwhile, rather than all recomputing it at
+    once. With `refresh_in_background`, even that process does so, and
+    the refresh happens in a thread pool. Stale results have to stay in the
+    cache for this, so `timeout` must be longer than `soft_timeout`; it
+    defaults to twice as long (or a minute longer, if that's more).
+
+    Results are invalidated when the object is saved or deleted, or by
+    `invalidate_cached_methods`. With `model_wide`, they are also
+    invalidated when any instance of the model is, e.g. for methods which
+    depend on other instances.
+
+    If `local_timeout` is given, results are also kept in memory in each
+    process for up to that many seconds, and looked for there first, in a
+    cache limited by GENERIC_CACHE_METHOD_LOCAL_MAX_ENTRIES and
+    GENERIC_CACHE_METHOD_LOCAL_MAX_BYTES. As their keys include the
+    generation, invalidated results are not used from there either.
+
+    See also `prefetch_cached`, to fetch results for many objects at once.
     """
+    if soft_timeout is not None:
+        if timeout is None:
+            timeout = soft_timeout + max(soft_timeout, 60)
+        elif timeout <= soft_timeout:
+            raise ValueError(
+                'cache_method timeout must be longer than soft_timeout')
+
     def inner(method):
         @wraps(method)
         def wrapped_method(self, *args, **kwargs):
             force_reload = kwargs.pop('force_reload', False)
             cache_obj = get_cache(cache_name) if cache_name else cache
-            cache_key = 'generic-%s-%s-%s' % (
-                self.__class__.__name__,
-                self.pk,
-                method.__name__,
-            )
-            for value in args:
-                if isinstance(value, (list, tuple)):
-                    value = ','.join(map(unicode, value))
-                cache_key += '-%s' % value
-            for key, value in kwargs.iteritems():
-                if isinstance(value, (list, tuple)):
-                    value = ','.join(map(unicode, value))
-                cache_key += '-%s=%s' % (key, value)
+            generation = _get_generation(
+                cache_obj, cache_name, self, model_wide)
+            cache_key = _get_cache_method_key(
+                self, method.__name__, args, kwargs, generation)
             debug_info = [cache_key]
 
+            primed = self.__dict__.get('_cache_method_primed', {})
+            local_key = (cache_name, cache_key)
+            local_value = _missing # to keep in the local cache, if any
+            local_result = _missing
+            if local_timeout is not None and not (
+                    force_reload or cache_key in primed):
+                local_result = _get_local_result(local_key)
             if force_reload:
                 result = method(self, *args, **kwargs)
-                cache_obj.set(cache_key, result)
+                local_value = _pack_cached_value(result, soft_timeout)
+                _set_cached_value(cache_obj, cache_key, local_value, timeout)
+                if cache_key in primed:
+                    primed[cache_key] = result
                 debug_info.append('forced reload')
+            elif cache_key in primed:
+                result = primed[cache_key]
+                debug_info.append('prefetched')
+            elif local_result is not _missing:
+                result = local_result
+                debug_info.append('local hit')
             else:
                 try:
-                    result = cache_obj.get(cache_key)
+                    cached = cache_obj.get(cache_key)
                 except Exception, e:
                     logger.warning('Cache error: {0}'.format(e))
-                    result = None
-                if result is None:
-                    if not cache_obj.has_key(cache_key):
-                        debug_info.append('miss')
-                        result = method(self, *args, **kwargs)
-                        cache_obj.set(cache_key, result)
+                    cached = None
+                result, stale = _unpack_cached_value(cached)
+                refresh_args = (
+                    method, self, args, kwargs, cache_obj, cache_key,
+                    timeout, soft_timeout,
+                )
+                if cached is None:
+                    debug_info.append('miss')
+                    result = method(self, *args, **kwargs)
+                    local_value = _pack_cached_value(result, soft_timeout)
+                    _set_cached_value(
+                        cache_obj, cache_key, local_value, timeout)
+                elif stale and _lock_cached_value(cache_obj, cache_key):
+                    if refresh_in_background:
+                        debug_info.append('stale, refreshing in background')
+                        _get_refresh_pool().apply_async(
+                            _refresh_cached_value_in_background,
+                            refresh_args,
+                        )
                     else:
-                        pass # in the cache, but result is None
+                        debug_info.append('stale, refreshing')
+                        result = _refresh_cached_value(*refresh_args)
+                        local_value = _pack_cached_value(result, soft_timeout)
+                elif stale:
+                    debug_info.append('stale, being refreshed')
                 else:
                     debug_info.append('hit')
+                    local_value = cached
+            if local_timeout is not None and local_value is not _missing:
+                _get_local_cache().set(local_key, local_value, local_timeout)
             debug_info.append(result)
             if getattr(settings, 'GENERIC_CACHE_METHOD_DEBUG', False):
                 logger.debug(u' -- '.join(map(unicode, debug_info)))
             return result
+        wrapped_method.cache_method = method
+        wrapped_method.cache_name = cache_name
+        wrapped_method.cache_timeout = timeout
+        wrapped_method.cache_soft_timeout = soft_timeout
+        wrapped_method.cache_model_wide = model_wide
+        wrapped_method.cache_local_timeout = local_timeout
         return wrapped_method
     return inner
 
 
+def prefetch_cached(objs, method_name, *args, **kwargs):
+    """
+    Fetches the results of the @cache_method method `method_name` of each of
+    `objs`, for `args` and `kwargs`, with a single `get_many`. Only misses
+    are computed, and stored with a single `set_many`; subsequent calls to
+    the method of each object (with the same arguments) then don't touch
+    the cache at all. E.g.
+
+        prefetch_cached(page.object_list, 'get_price', currency)
+    """
+    groups = {}
+    for obj in objs:
+        wrapped_method = getattr(obj.__class__, method_name)
+        groups.setdefault((
+            wrapped_method.cache_name,
+            wrapped_method.cache_timeout,
+            wrapped_method.cache_model_wide,
+            wrapped_method.cache_local_timeout,
+        ), []).append((wrapped_method, obj))
+
+    for (
+            cache_name, timeout, model_wide, local_timeout
+    ), group in groups.iteritems():
+        cache_obj = get_cache(cache_name) if cache_name else cache
+        _load_generations(
+            cache_obj, cache_name, [obj for _, obj in group], model_wide)
+        methods = {}
+        for wrapped_method, obj in group:
+            cache_key = _get_cache_method_key(
+                obj, method_name, args, kwargs,
+                _get_generation(cache_obj, cache_name, obj, model_wide))
+            if local_timeout is not None:
+                result = _get_local_result((cache_name, cache_key))
+                if result is not _missing:
+                    _prime_cached_method(obj, cache_key, result)
+                    continue
+            methods[cache_key] = (wrapped_method, obj)
+        if not methods:
+            continue
+        try:
+            cached = cache_obj.get_many(methods.keys())
+        except Exception, e:
+            logger.warning('Cache error: {0}'.format(e))
+            cached = {}
+        missing = {}
+        for cache_key, (wrapped_method, obj) in methods.iteritems():
+            result, stale = _unpack_cached_value(cached.get(cache_key))
+            if not cache_key in cached or (
+                    stale and _lock_cached_value(cache_obj, cache_key)):
+                result = wrapped_method.cache_method(obj, *args, **kwargs)
+                missing[cache_key] = _pack_cached_value(
+                    result, wrapped_method.cache_soft_timeout)
+                if local_timeout is not None:
+                    _get_local_cache().set(
+                        (cache_name, cache_key), missing[cache_key],
+                        local_timeout)
+            elif local_timeout is not None and not stale:
+                _get_local_cache().set(
+                    (cache_name, cache_key), cached[cache_key], local_timeout)
+            _prime_cached_method(obj, cache_key, result)
+        if missing:
+            if timeout is None:
+                cache_obj.set_many(missing)
+            else:
+                cache_obj.set_many(missing, timeout)
+            for cache_key in missing:
+                if cache_key in cached: # i.e. was stale, and so locked
+                    _unlock_cached_value(cache_obj, cache_key)
+
+
 def cache_result_in_instance(method):
     """
     Caches the results of a method into its object instance using the passed
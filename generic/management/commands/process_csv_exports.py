@@ -0,0 +1,45 @@
+import multiprocessing
+import time
+from optparse import make_option
+
+from django.contrib import admin
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from ...admin.mixins.csv import CSVExportJob, run_csv_export_job
+
+class Command(BaseCommand):
+    help = (
+        'Runs queued CSVExportAdmin background exports, resuming any which '
+        'were interrupted.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', default=None,
+            help='Number of jobs to run at once (default: one per CPU)'),
+        make_option('--interval', type='int', default=5,
+            help='Seconds to wait between checks of the queue'),
+        make_option('--once', action='store_true', default=False,
+            help='Exit once the queue is empty rather than polling'),
+    )
+
+    def handle(self, *args, **options):
+        admin.autodiscover()
+        verbosity = int(options.get('verbosity', 1))
+        for connection in connections.all():
+            connection.close() # so workers don't inherit them when forked
+        pool = multiprocessing.Pool(options['processes'])
+        try:
+            while True:
+                job_ids = CSVExportJob.get_runnable_ids()
+                if job_ids:
+                    if verbosity >= 1:
+                        self.stdout.write(
+                            'Running %d export(s)\n' % len(job_ids))
+                    pool.map(run_csv_export_job, job_ids, chunksize=1)
+                elif options['once']:
+                    break
+                else:
+                    time.sleep(options['interval'])
+        finally:
+            pool.close()
+            pool.join()
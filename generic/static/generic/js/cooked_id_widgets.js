@@ -1,71 +1,140 @@
 (
     function($){
         $(document).ready(function(){
-            window.update_cooked_field = function(field, is_inline_field, is_stacked_inline_field){
-                if (!is_inline_field) is_inline_field = false;
-                if (!is_stacked_inline_field) is_stacked_inline_field = false;
-                $(field).hide();
-                var container = "";
+            var get_cooked_container = function(field, is_inline_field, is_stacked_inline_field){
                 if (is_inline_field && !is_stacked_inline_field) {
-                    container = $(field).closest('td');
+                    return $(field).closest('td');
                 } else {
-                    container = $(field).closest('div');
+                    return $(field).closest('div');
                 }
+            };
+
+            // Type-ahead search, so that adding items doesn't need the raw id
+            // popup and its full change list
+            var add_cooked_search = function(field, is_inline_field){
+                if ($(field).data('cooked-search')) return;
+                var url_base = window.cooked_id_url_base || './';
+                var search_url = "";
+                if (is_inline_field) {
+                    search_url = url_base + 'cook-ids-inline-search/' + $(field).attr('data-model') + '/' + $(field).attr('data-field') + '/';
+                } else {
+                    search_url = url_base + 'cook-ids-search/' + $(field).attr('name') + '/';
+                }
+                var input = $('<input type="text" class="cooked-search" autocomplete="off" />');
+                var results = $('<ul class="cooked-search-results"></ul>').hide();
+                input.insertAfter(field);
+                results.insertAfter(input);
+                $(field).data('cooked-search', input);
+
+                var search = function(after){
+                    var params = {'q': input.val()};
+                    if (after) params['after'] = after;
+                    $.get(search_url, params, function(response){
+                        if (!after) results.html('');
+                        $('.cooked-search-more', results).remove();
+                        $.each(response['results'], function(index, result){
+                            $('<li></li>').text(result[1]['text']).attr('data-id', result[0]).appendTo(results);
+                        });
+                        if (response['next']) {
+                            $('<li class="cooked-search-more">...</li>').attr('data-next', response['next']).appendTo(results);
+                        }
+                        if (results.children().length) {
+                            results.show();
+                        } else {
+                            results.hide();
+                        }
+                    }, 'json');
+                };
+
+                var timer = null;
+                input.bind('keyup', function(event){
+                    clearTimeout(timer);
+                    timer = setTimeout(function(){
+                        if (input.val()) {
+                            search();
+                        } else {
+                            results.hide().html('');
+                        }
+                    }, 250);
+                });
+
+                results.delegate('li', 'click', function(event){
+                    if ($(this).hasClass('cooked-search-more')) {
+                        search($(this).attr('data-next'));
+                        return;
+                    }
+                    var id = $(this).attr('data-id');
+                    if ($(field).hasClass('vManyToManyRawIdAdminField')) {
+                        var values = $(field).val() ? $(field).val().split(',') : [];
+                        if ($.inArray(id, values) == -1) values.push(id);
+                        $(field).val(values.join(','));
+                    } else {
+                        $(field).val(id);
+                    }
+                    input.val('');
+                    results.hide().html('');
+                    $(field).triggerHandler('change');
+                });
+            };
+
+            var prepare_cooked_field = function(field, is_inline_field, is_stacked_inline_field){
+                add_cooked_search(field, is_inline_field);
+                $(field).hide();
+                var container = get_cooked_container(field, is_inline_field, is_stacked_inline_field);
                 $('.help', container).html(
                     'Click cross icons to remove existing items, ' +
                     'or magnifying glass icon to add more.'
                 );
-                var field_name = $(field).attr('name');
-                var ids = escape($(field).val());
-                if (ids){
-                    var url_base = window.cooked_id_url_base || './';
-                    var cook_url = "";
+                return container;
+            };
+
+            // Not by selector, which pks could break out of
+            var get_cooked_item = function(cooked, id){
+                return $('li', cooked).filter(function(){
+                    return $(this).attr('data-id') == id;
+                });
+            };
+
+            window.render_cooked_field = function(field, response, is_inline_field, is_stacked_inline_field){
+                var container = get_cooked_container(field, is_inline_field, is_stacked_inline_field);
+                var cooked = $('.cooked-data', container);
+                cooked.html('');
+                $.each(response, function(key, data){
                     if (is_inline_field) {
-                        var model_name = $(field).attr('data-model');
-                        field_name = $(field).attr('data-field');
-                        cook_url = url_base + 'cook-ids-inline/' + model_name + '/' + field_name + '/' + ids + '/';
+                        if (is_stacked_inline_field) {
+                            $('<li></li>').attr('data-id', key).text(data['text']).append(
+                                ' <a onclick="remove_stacked_inline_cooked_item(this);"' +
+                                ' title="remove">&nbsp;</a>'
+                            ).appendTo(cooked);
+                        } else {
+                            $('<li></li>').attr('data-id', key).text(data['text']).append(
+                                ' <a onclick="remove_tabular_inline_cooked_item(this);"' +
+                                ' title="remove">&nbsp;</a>'
+                            ).appendTo(cooked);
+                        }
                     } else {
-                        cook_url = url_base + 'cook-ids/' + field_name + '/' + ids + '/';
+                        $('<li></li>').attr('data-id', key).text(data['text']).append(
+                            ' <a onclick="remove_cooked_item(this);"' +
+                            ' title="remove">&nbsp;</a>'
+                        ).appendTo(cooked);
                     }
-                    $.get(cook_url, function(response){
-                        var cooked = $('.cooked-data', container);
-                        cooked.html('');
-                        $.each(response, function(key, data){
-                            if (is_inline_field) {
-                                if (is_stacked_inline_field) {
-                                    $('<li data-id="'+key+'"></li>').text(data['text']).append(
-                                        ' <a onclick="remove_stacked_inline_cooked_item(this);"' +
-                                        ' title="remove">&nbsp;</a>'
-                                    ).appendTo(cooked);
-                                } else {
-                                    $('<li data-id="'+key+'"></li>').text(data['text']).append(
-                                        ' <a onclick="remove_tabular_inline_cooked_item(this);"' +
-                                        ' title="remove">&nbsp;</a>'
-                                    ).appendTo(cooked);
-                                }
-                            } else {
-                                $('<li data-id="'+key+'"></li>').text(data['text']).append(
-                                    ' <a onclick="remove_cooked_item(this);"' +
-                                    ' title="remove">&nbsp;</a>'
-                                ).appendTo(cooked);
-                            }
 
-                            if(data['can_view'] || data['can_edit']) {
-                                var options = {};
-                                if(data['can_view'])
-                                {
-                                    options['View'] = {click: function(element) {
-                                        window.location.href = data['can_view'];
-                                    }}
-                                }
-                                if(data['can_edit']) {
-                                    options['Edit'] = {click: function(element) {
-                                        window.location.href = data['base_url'] + key + '/';
-                                    }}
-                                }
-
-                                $('li[data-id='+key+']').contextMenu('context-menu-'+key, options);
-                            }
+                    if(data['can_view'] || data['can_edit']) {
+                        var options = {};
+                        if(data['can_view'])
+                        {
+                            options['View'] = {click: function(element) {
+                                window.location.href = data['can_view'];
+                            }}
+                        }
+                        if(data['can_edit']) {
+                            options['Edit'] = {click: function(element) {
+                                window.location.href = data['base_url'] + key + '/';
+                            }}
+                        }
+
+                        get_cooked_item(cooked, key).contextMenu('context-menu-'+key, options);
+                    }
 
 														if(data['view_url'] || data['edit_url']) {
 																var options = {};
@@ -84,12 +153,62 @@
 																		}
 																}
 
-																$('li[data-id='+key+']').contextMenu('context-menu-'+key, options);
+																get_cooked_item(cooked, key).contextMenu('context-menu-'+key, options);
 														}
 
-                        });
-                    });
+                });
+            };
+
+            // Cooks any number of fields with a single request; `fields` is
+            // a list of [field, is_inline_field, is_stacked_inline_field]
+            window.update_cooked_fields = function(fields){
+                var to_cook = {};
+                var to_render = {};
+                var count = 0;
+                $.each(fields, function(index, args){
+                    var field = args[0];
+                    var is_inline_field = args[1] || false;
+                    var is_stacked_inline_field = args[2] || false;
+                    prepare_cooked_field(field, is_inline_field, is_stacked_inline_field);
+                    var ids = $(field).val();
+                    $(field).data('cooked_value', ids);
+                    if (ids){
+                        var spec = {'field': $(field).attr('name'), 'ids': ids};
+                        if (is_inline_field) {
+                            spec['model'] = $(field).attr('data-model');
+                            spec['field'] = $(field).attr('data-field');
+                        }
+                        to_cook[index] = spec;
+                        to_render[index] = args;
+                        count++;
+                    }
+                });
+                if (!count) return;
+                var url_base = window.cooked_id_url_base || './';
+                var data = {'fields': JSON.stringify(to_cook)};
+                // GET, so that the browser can cache and revalidate the
+                // response, unless the URL would be too long for servers
+                var type = 'GET';
+                if (encodeURIComponent(data['fields']).length > 1500) {
+                    type = 'POST';
+                    data['csrfmiddlewaretoken'] = $('input[name=csrfmiddlewaretoken]').val();
                 }
+                $.ajax({
+                    url: url_base + 'cook-ids-batch/',
+                    type: type,
+                    data: data,
+                    dataType: 'json',
+                    success: function(response){
+                        $.each(response, function(index, data){
+                            var args = to_render[index];
+                            render_cooked_field(args[0], data, args[1], args[2]);
+                        });
+                    }
+                });
+            };
+
+            window.update_cooked_field = function(field, is_inline_field, is_stacked_inline_field){
+                update_cooked_fields([[field, is_inline_field, is_stacked_inline_field]]);
             };
 
             window.remove_cooked_item = function(remove_link){
@@ -149,9 +268,22 @@
                 $(window).trigger('dismissAddAnotherPopup');
             }
 
+            // Initial values are cooked when the page is rendered, so only
+            // fields without them need to be requested
+            var fields = [];
+            var init_cooked_field = function(args){
+                var container = prepare_cooked_field(args[0], args[1], args[2]);
+                $(args[0]).data('cooked_value', $(args[0]).val());
+                var precooked = $('.cooked-data', container).data('cooked');
+                if (precooked === undefined) {
+                    fields.push(args);
+                } else {
+                    render_cooked_field(args[0], precooked, args[1], args[2]);
+                }
+            };
             $('.CookedIdField').each(
                 function(index, element){
-                    update_cooked_field(element);
+                    init_cooked_field([element]);
                     $(element).bind(
                         'change', function(event){
                             update_cooked_field(event.target);
@@ -161,7 +293,7 @@
             );
             $('.TabularInlineCookedIdField').each(
                 function(index, element){
-                    update_cooked_field(element, true);
+                    init_cooked_field([element, true]);
                     $(element).bind(
                         'change', function(event){
                             update_cooked_field(event.target, true);
@@ -171,7 +303,7 @@
             );
             $('.StackedInlineCookedIdField').each(
                 function(index, element){
-                    update_cooked_field(element, true, true);
+                    init_cooked_field([element, true, true]);
                     $(element).bind(
                         'change', function(event){
                             update_cooked_field(event.target, true, true);
@@ -179,20 +311,30 @@
                     );
                 }
             );
-            $(window).bind('dismissRelatedLookupPopup', function(event){
-                $('.CookedIdField, .TabularInlineCookedIdField, .StackedInlineCookedIdField').each(
-                    function(index, element){
-                        $(element).triggerHandler('change');
-                    }
-                );
-            });
-            $(window).bind('dismissAddAnotherPopup', function(event){
-                $('.CookedIdField, .TabularInlineCookedIdField, .StackedInlineCookedIdField').each(
-                    function(index, element){
-                        $(element).triggerHandler('change');
+            update_cooked_fields(fields);
+
+            // A popup may have changed any of the fields, so re-cook those
+            // whose values differ from when they were last cooked, together
+            var update_changed_cooked_fields = function(){
+                var changed = [];
+                $.each(
+                    [
+                        ['.CookedIdField', false, false],
+                        ['.TabularInlineCookedIdField', true, false],
+                        ['.StackedInlineCookedIdField', true, true]
+                    ],
+                    function(index, args){
+                        $(args[0]).each(function(index, element){
+                            if ($(element).val() != $(element).data('cooked_value')) {
+                                changed.push([element, args[1], args[2]]);
+                            }
+                        });
                     }
                 );
-            });
+                update_cooked_fields(changed);
+            };
+            $(window).bind('dismissRelatedLookupPopup', update_changed_cooked_fields);
+            $(window).bind('dismissAddAnotherPopup', update_changed_cooked_fields);
         });
     }
 )(django.jQuery);
@@ -1,7 +1,33 @@
+import cStringIO
+import datetime
+import decimal
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
+import zipfile
 from django import http
-from django.test import TestCase
+from django.conf.urls import include, patterns, url
+from django.contrib import admin
+from django.contrib.auth.models import Group, Permission, User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import signals
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.test.client import RequestFactory
 from . import decorators
+from .admin.mixins import (
+    BatchUpdateAdmin, CookedIdAdmin, CSVExportAdmin, CSVImportAdmin,
+    TabularInlineCookedIdAdmin)
+from .admin.mixins.batch import BatchUpdateForm
+from .admin.mixins.csv import CSVExportJob, CSVExportPlan
+from .models import Relatable
+from .utils import export_formats, querysets, unicode_csv
 
 request_factory = RequestFactory()
 
@@ -25,3 +51,892 @@ class GenericTest(TestCase):
         response = return_http_response(request)
         self.assertTrue('text/html' in response['Content-Type'])
         self.assertEqual(response.content, 'test')
+
+
+class UnicodeCSVTest(TestCase):
+    rows = [
+        [1, u'Caf\xe9', 'bytes', 1.5, datetime.date(2014, 1, 2), None],
+        [2, u'"quoted"', '', True, datetime.date(2014, 1, 3), u''],
+    ]
+
+    def write(self, encoding, batched):
+        output = cStringIO.StringIO()
+        writer = unicode_csv.Writer(output, encoding=encoding)
+        writer.batch_size = 1
+        if batched:
+            writer.writerows(self.rows)
+        else:
+            for row in self.rows:
+                writer.writerow(row)
+        return output.getvalue()
+
+    def test_writerows(self):
+        self.assertEqual(
+            self.write('utf-8', batched=True),
+            '1,Caf\xc3\xa9,bytes,1.5,2014-01-02,None\r\n'
+            '2,"""quoted""",,True,2014-01-03,\r\n'
+        )
+        for encoding in ('utf-8', 'utf-16', 'latin-1'):
+            self.assertEqual(
+                self.write(encoding, batched=True),
+                self.write(encoding, batched=False),
+            )
+
+
+class ExportFormatsTest(TestCase):
+    titles = [u'Number', u'Name']
+    row_blocks = [[[1, u'Caf\xe9']], [[2, None], [3, u'<&>']]]
+
+    def serialize(self, format_name):
+        export_format = export_formats.FORMATS[format_name](self.titles)
+        return ''.join(export_format.serialize(self.row_blocks))
+
+    def test_gzip_csv(self):
+        self.assertEqual(
+            gzip.GzipFile(
+                fileobj=cStringIO.StringIO(self.serialize('csv.gz'))).read(),
+            self.serialize('csv'),
+        )
+
+    def test_ndjson(self):
+        self.assertEqual(
+            map(json.loads, self.serialize('ndjson').splitlines()), [
+                {u'Number': 1, u'Name': u'Caf\xe9'},
+                {u'Number': 2, u'Name': None},
+                {u'Number': 3, u'Name': u'<&>'},
+            ]
+        )
+
+    def test_xlsx(self):
+        archive = zipfile.ZipFile(cStringIO.StringIO(self.serialize('xlsx')))
+        self.assertEqual(archive.testzip(), None)
+        sheet = archive.read('xl/worksheets/sheet1.xml')
+        self.assertEqual(sheet.count('<row>'), 4)
+        self.assertTrue('&lt;&amp;&gt;' in sheet)
+
+    def test_xlsx_numbers(self):
+        encode_cell = export_formats.FORMATS['xlsx'](self.titles).encode_cell
+        self.assertEqual(
+            encode_cell(0.1 + 0.2), '<c><v>0.30000000000000004</v></c>')
+        self.assertEqual(
+            encode_cell(2 ** 64), '<c><v>18446744073709551616</v></c>')
+        for value in (
+                float('nan'), float('inf'), decimal.Decimal('-Infinity')):
+            self.assertTrue('<v>' not in encode_cell(value))
+
+
+class Priced(object):
+    calls = 0
+
+    def __init__(self, pk):
+        self.pk = pk
+
+    @decorators.cache_method()
+    def get_price(self, quantity):
+        Priced.calls += 1
+        return self.pk * quantity
+
+    @decorators.cache_method(soft_timeout=60)
+    def get_stock(self):
+        Priced.calls += 1
+        return self.pk
+
+    @decorators.cache_method()
+    def get_nothing(self):
+        Priced.calls += 1
+
+    @decorators.cache_method(local_timeout=60)
+    def get_name(self):
+        Priced.calls += 1
+        return 'Priced %s' % self.pk
+
+
+class ShortCached(Priced):
+    @decorators.cache_method(cache_name='short', timeout=60)
+    def get_price(self, quantity):
+        Priced.calls += 1
+        return self.pk * quantity
+
+
+class CacheMethodTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        Priced.calls = 0
+
+    def test_prefetch_cached(self):
+        Priced(1).get_price(2)
+        objs = [Priced(pk) for pk in (1, 2, 3)]
+        decorators.prefetch_cached(objs, 'get_price', 2)
+        self.assertEqual(Priced.calls, 3) # 1 was already cached
+        cache.clear()
+        self.assertEqual([obj.get_price(2) for obj in objs], [2, 4, 6])
+        self.assertEqual(Priced.calls, 3)
+
+    def test_invalidate_cached_methods(self):
+        Priced(1).get_price(2)
+        Priced(2).get_price(2)
+        decorators.invalidate_cached_methods(Priced(1))
+        Priced(1).get_price(2)
+        Priced(2).get_price(2)
+        self.assertEqual(Priced.calls, 3) # only 1 was recomputed
+
+    def test_local_cache(self):
+        obj = Priced(1)
+        obj.get_name()
+        cache.delete(decorators._get_cache_method_key(
+            obj, 'get_name', (), {},
+            decorators._get_generation(cache, None, obj, False)))
+        self.assertEqual(Priced(1).get_name(), 'Priced 1')
+        self.assertEqual(Priced.calls, 1) # from the local cache
+        decorators.invalidate_cached_methods(obj)
+        self.assertEqual(Priced(1).get_name(), 'Priced 1')
+        self.assertEqual(Priced.calls, 2)
+
+    def test_local_cache_bounds(self):
+        local_cache = decorators._LocalCache(max_entries=2, max_bytes=1000)
+        local_cache.set('a', 1, 60)
+        local_cache.set('b', 2, 60)
+        local_cache.get('a')
+        local_cache.set('c', 3, 60) # evicts b, the least recently used
+        self.assertEqual(local_cache.get('b'), None)
+        self.assertEqual(local_cache.get('a'), 1)
+        local_cache.set('d', 'x' * 1000, 60) # too big to keep
+        self.assertEqual(local_cache.get('d'), None)
+        local_cache.set('e', 5, -1) # already expired
+        self.assertEqual(local_cache.get('e'), None)
+        self.assertEqual(local_cache.get('a'), 1)
+
+    def test_cache_method_key(self):
+        obj = Priced(1)
+        get_key = lambda *args, **kwargs: decorators._get_cache_method_key(
+            obj, 'get_price', args, kwargs, '1')
+        self.assertEqual(get_key(a=1, b=2), get_key(b=2, a=1))
+        self.assertNotEqual(get_key('1'), get_key(1))
+        self.assertNotEqual(get_key('a,b'), get_key(['a', 'b']))
+        self.assertNotEqual(get_key('a', 'b'), get_key('a,b'))
+        for key in (get_key('x' * 1000), get_key(u'caf\xe9 au lait')):
+            self.assertTrue(len(key) <= decorators.MAX_CACHE_KEY_LENGTH)
+            self.assertTrue(decorators.SAFE_CACHE_KEY.match(key))
+
+    def test_cached_none(self):
+        obj = Priced(0)
+        self.assertEqual(obj.get_nothing(), None)
+        self.assertEqual(Priced(0).get_nothing(), None)
+        self.assertEqual(Priced.calls, 1)
+
+    def test_generations_outlive_default_timeout(self):
+        caches = dict(settings.CACHES, short={
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'generic-tests-short',
+            'TIMEOUT': 1,
+        })
+        with override_settings(CACHES=caches):
+            ShortCached(1).get_price(2)
+            time.sleep(1.5) # past the cache's default timeout
+            self.assertEqual(ShortCached(1).get_price(2), 2)
+        self.assertEqual(Priced.calls, 1)
+
+    def test_deferred_instances_share_keys(self):
+        group = Group.objects.create(name='a')
+        deferred = Group.objects.only('pk').get()
+        self.assertNotEqual(deferred.__class__, Group)
+        self.assertEqual(
+            decorators._get_generation_key(deferred.__class__, deferred.pk),
+            decorators._get_generation_key(Group, group.pk))
+        self.assertEqual(
+            decorators._get_cache_method_key(deferred, 'x', (), {}, '1'),
+            decorators._get_cache_method_key(group, 'x', (), {}, '1'))
+
+    def test_soft_timeout_needs_longer_timeout(self):
+        self.assertEqual(Priced.get_stock.cache_timeout, 120)
+        self.assertRaises(
+            ValueError, decorators.cache_method, timeout=60, soft_timeout=60)
+
+    def test_soft_timeout(self):
+        obj = Priced(1)
+        key = decorators._get_cache_method_key(
+            obj, 'get_stock', (), {},
+            decorators._get_generation(cache, None, obj, False))
+        cache.set(key, decorators._SoftExpiringValue(0, 0)) # i.e. stale
+        cache.add(key + '-lock', 1)
+        self.assertEqual(obj.get_stock(), 0) # being refreshed elsewhere
+        self.assertEqual(Priced.calls, 0)
+        cache.delete(key + '-lock')
+        self.assertEqual(obj.get_stock(), 1)
+        self.assertEqual(Priced.calls, 1)
+        self.assertEqual(obj.get_stock(), 1) # fresh until soft_timeout
+        self.assertEqual(Priced.calls, 1)
+
+
+class GroupCookedIdAdmin(CookedIdAdmin):
+    cooked_id_fields = ('groups',)
+
+    def get_cooked_edit_url_template(self, request, model):
+        return '' # the admin's URLs needn't be installed
+
+
+class MembershipInline(TabularInlineCookedIdAdmin):
+    model = User.groups.through
+    cooked_id_fields = ('group',)
+
+
+class CachedGroupCookedIdAdmin(GroupCookedIdAdmin):
+    cooked_id_cache = 'default'
+
+
+class ProxyGroup(Group):
+    class Meta:
+        proxy = True
+        app_label = 'auth' # apps without migrations can't extend its models
+
+
+class CookedIdAdminTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.site = admin.AdminSite()
+        self.site.register(Group)
+        self.user = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'admin')
+        self.groups = [
+            Group.objects.create(name=name) for name in ('a', 'b', 'c')]
+
+    def cook_ids_batch(self, model_admin, fields):
+        request = request_factory.post('/', {'fields': json.dumps(fields)})
+        request.user = self.user
+        return json.loads(model_admin.cook_ids_batch(request, None).content)
+
+    def test_cache_invalidated_by_proxy(self):
+        model_admin = CachedGroupCookedIdAdmin(User, self.site)
+        pk = str(self.groups[0].pk)
+        fields = {'x': {'field': 'groups', 'ids': pk}}
+        self.cook_ids_batch(model_admin, fields)
+        group = ProxyGroup.objects.get(pk=pk)
+        group.name = 'renamed'
+        group.save()
+        self.assertEqual(
+            self.cook_ids_batch(model_admin, fields)['x'][pk]['text'],
+            'renamed',
+        )
+
+    def test_cache_keys(self):
+        model_admin = CachedGroupCookedIdAdmin(User, self.site)
+        request = request_factory.get('/')
+        request.user = self.user
+        key = model_admin.get_cooked_id_cache_key(
+            request, 'groups', u'caf\xe9 au lait')
+        self.assertTrue(decorators.SAFE_CACHE_KEY.match(key))
+
+    def test_cache_respects_queryset(self):
+        model_admin = CachedGroupCookedIdAdmin(User, self.site)
+        fields = {'x': {'field': 'groups', 'ids': '%s,%s' % (
+            self.groups[0].pk, self.groups[1].pk)}}
+        self.assertEqual(
+            sorted(self.cook_ids_batch(model_admin, fields)['x']),
+            [str(self.groups[0].pk), str(self.groups[1].pk)],
+        )
+        class GroupAdmin(admin.ModelAdmin):
+            def get_queryset(self, request):
+                return Group.objects.exclude(name='b')
+        self.site.unregister(Group)
+        self.site.register(Group, GroupAdmin)
+        self.assertEqual(
+            self.cook_ids_batch(model_admin, fields)['x'].keys(),
+            [str(self.groups[0].pk)],
+        )
+
+    def test_cook_ids_batch_malformed(self):
+        model_admin = GroupCookedIdAdmin(User, self.site)
+        for fields in (
+                [],
+                {'x': 'groups'},
+                {'x': {'field': ['groups'], 'ids': '1'}},
+                {'x': {'field': 'groups', 'model': {}, 'ids': '1'}},
+                {'x': {'field': 'groups', 'ids': 1}},
+                {'x': {'field': 'groups'}},
+        ):
+            request = request_factory.post(
+                '/', {'fields': json.dumps(fields)})
+            request.user = self.user
+            self.assertEqual(
+                model_admin.cook_ids_batch(request, None).status_code, 400)
+
+    def test_cook_many_gets_list(self):
+        class CountingAdmin(GroupCookedIdAdmin):
+            def cook_many(self, objs, request, field_name):
+                self.pks = [obj.pk for obj in objs] # e.g. to load more
+                return super(CountingAdmin, self).cook_many(
+                    objs, request, field_name)
+        model_admin = CountingAdmin(User, self.site)
+        pk = str(self.groups[0].pk)
+        response = self.cook_ids_batch(
+            model_admin, {'x': {'field': 'groups', 'ids': pk}})
+        self.assertEqual(response['x'].keys(), [pk])
+        self.assertEqual(model_admin.pks, [self.groups[0].pk])
+
+    def test_search(self):
+        class GroupAdmin(admin.ModelAdmin):
+            search_fields = ('name',)
+        self.site.unregister(Group)
+        self.site.register(Group, GroupAdmin)
+        model_admin = GroupCookedIdAdmin(User, self.site)
+        model_admin.cooked_id_search_limit = 2
+        for name in ('ab', 'xab', 'abc', 'Abd'):
+            Group.objects.create(name=name)
+        def search(user=self.user, **params):
+            request = request_factory.get('/', params)
+            request.user = user
+            return json.loads(model_admin.cook_ids_search(
+                request, None, 'groups').content)
+        def get_names(response):
+            return [cooked['text'] for pk, cooked in response['results']]
+        response = search(q='ab')
+        self.assertEqual(get_names(response), ['ab', 'abc'])
+        self.assertEqual(response['next'], response['results'][-1][0])
+        response = search(q='ab', after=response['next'])
+        self.assertEqual(get_names(response), ['Abd']) # not 'xab'
+        self.assertEqual(response['next'], None)
+        self.assertEqual(search(q='')['results'], [])
+        staff = User.objects.create(username='staff', is_staff=True)
+        self.assertEqual(search(user=staff, q='ab')['results'], [])
+        self.assertRaises(
+            http.Http404, search, q='ab', after='x') # not a pk
+
+    def test_parse_cooked_ids(self):
+        model_admin = GroupCookedIdAdmin(User, self.site)
+        self.assertEqual(model_admin.parse_cooked_ids('groups', ''), [])
+        self.assertEqual(
+            model_admin.parse_cooked_ids('groups', '1,2'), [1, 2])
+        self.assertRaises(
+            http.Http404, model_admin.parse_cooked_ids, 'groups', '1,x')
+
+    def test_cook_ids_batch(self):
+        model_admin = GroupCookedIdAdmin(User, self.site)
+        a, b, c = [str(group.pk) for group in self.groups]
+        response = self.cook_ids_batch(model_admin, {
+            'x': {'field': 'groups', 'ids': '%s,%s' % (a, b)},
+            'y': {'field': 'groups', 'ids': '%s,0' % c}, # 0 doesn't exist
+            'z': {'field': 'user_permissions', 'ids': '1'}, # not cooked
+        })
+        self.assertEqual(sorted(response['x']), [a, b])
+        self.assertEqual(response['z'], {})
+        self.assertEqual(response['y'], {c: {
+            'text': 'c', 'view_url': '', 'edit_url': ''}})
+
+    def test_cook_ids_batch_inline(self):
+        class InlineGroupCookedIdAdmin(GroupCookedIdAdmin):
+            inlines = [MembershipInline]
+        model_admin = InlineGroupCookedIdAdmin(User, self.site)
+        pk = str(self.groups[0].pk)
+        response = self.cook_ids_batch(model_admin, {
+            'x': {'model': 'user_groups', 'field': 'group', 'ids': pk},
+            'y': {'model': 'user_groups', 'field': 'user', 'ids': '1'},
+            'z': {'model': 'group', 'field': 'group', 'ids': pk},
+        })
+        self.assertEqual(response['x'].keys(), [pk])
+        self.assertEqual(response['x'][pk]['text'], 'a')
+        self.assertEqual(response['y'], {}) # not cooked
+        self.assertEqual(response['z'], {}) # not an inline
+
+    def test_cook_ids_batch_get(self):
+        model_admin = GroupCookedIdAdmin(User, self.site)
+        fields = json.dumps({'x': {'field': 'groups', 'ids': '%s,%s' % (
+            self.groups[0].pk, self.groups[1].pk)}})
+        def get(**headers):
+            request = request_factory.get('/', {'fields': fields}, **headers)
+            request.user = self.user
+            return model_admin.cook_ids_batch(request, None)
+        response = get()
+        self.assertFalse(response.has_header('ETag')) # no date_modified
+        self.assertTrue('private' in response['Cache-Control'])
+        model_admin.cooked_id_modified_field = 'name'
+        etag = get()['ETag']
+        self.assertEqual(get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        Group.objects.filter(pk=self.groups[0].pk).update(name='d')
+        response = get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class UserCookedIdAdmin(CookedIdAdmin):
+    fields = ('username', 'groups', 'user_permissions')
+    cooked_id_fields = ('groups', 'user_permissions')
+
+
+class PermissionAdmin(admin.ModelAdmin):
+    def get_queryset(self, request):
+        # for their text
+        return super(PermissionAdmin, self).get_queryset(
+            request).select_related('content_type')
+
+
+test_site = admin.AdminSite()
+test_site.register(Group)
+test_site.register(Permission, PermissionAdmin)
+test_site.register(User, UserCookedIdAdmin)
+
+urlpatterns = patterns('', url(r'^admin/', include(test_site.urls)))
+
+
+class CookedIdChangeFormTest(TestCase):
+    urls = 'generic.tests'
+
+    def setUp(self):
+        self.user = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'admin')
+        self.group = Group.objects.create(name='editors')
+        self.user.groups.add(self.group)
+        self.user.user_permissions.add(*Permission.objects.all()[:2])
+        self.model_admin = test_site._registry[User]
+
+    def test_change_form(self):
+        self.client.login(username='admin', password='admin')
+        response = self.client.get('/admin/auth/user/%s/' % self.user.pk)
+        self.assertContains(response, 'data-cooked', count=2)
+        self.assertContains(response, '/admin/auth/group/%s/' % self.group.pk)
+
+    def test_precook_queries(self):
+        request = request_factory.get('/')
+        request.user = self.user
+        form = self.model_admin.get_form(request, self.user)(
+            instance=self.user)
+        with self.assertNumQueries(2): # one per target model
+            self.model_admin.precook_forms(
+                request, [(self.model_admin, form)])
+        self.assertEqual(form.fields['groups'].widget.widget.cooked, {
+            self.group.pk: {
+                'text': 'editors',
+                'view_url': '',
+                'edit_url': '/admin/auth/group/%s/' % self.group.pk,
+            },
+        })
+        self.assertEqual(
+            len(form.fields['user_permissions'].widget.widget.cooked), 2)
+
+    def test_edit_url_needs_permission(self):
+        class GroupAdmin(admin.ModelAdmin):
+            def has_change_permission(self, request, obj=None):
+                return True # i.e. any staff user can pick groups
+        site = admin.AdminSite()
+        site.register(Group, GroupAdmin)
+        model_admin = UserCookedIdAdmin(User, site)
+        request = request_factory.get('/')
+        request.user = User.objects.create(username='staff', is_staff=True)
+        self.assertEqual(
+            model_admin.get_cooked_ids(request, 'groups', [self.group.pk]),
+            {self.group.pk: {
+                'text': 'editors', 'view_url': '', 'edit_url': ''}},
+        )
+
+
+class GroupCSVImportAdmin(CSVImportAdmin):
+    csv_import_fields = ('name',)
+
+
+class UserCSVImportAdmin(CSVImportAdmin):
+    csv_import_fields = ('username', 'first_name')
+    csv_import_key = ('username',)
+
+
+class CSVImportAdminTest(TestCase):
+    def setUp(self):
+        self.request = request_factory.get('/')
+        self.request.user = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'admin')
+
+    def csv_import(self, model_admin_class, model, lines):
+        model_admin = model_admin_class(model, admin.AdminSite())
+        return model_admin.csv_import(
+            self.request, cStringIO.StringIO('\r\n'.join(lines)))
+
+    def test_errors(self):
+        Group.objects.create(name='existing')
+        result = self.csv_import(GroupCSVImportAdmin, Group, [
+            'name', 'alpha', '', 'beta', 'existing', 'gamma'])
+        self.assertEqual(result.created, 3)
+        # invalid, and rejected by the database
+        self.assertEqual([row for row, errors in result.errors], [3, 5])
+        self.assertEqual(
+            sorted(Group.objects.values_list('name', flat=True)),
+            ['alpha', 'beta', 'existing', 'gamma'],
+        )
+
+    def test_upsert(self):
+        User.objects.create(username='bob', first_name='Old')
+        result = self.csv_import(UserCSVImportAdmin, User, [
+            'Username,First name', 'bob,Bob', 'carol,Carol'])
+        self.assertEqual((result.created, result.updated), (1, 1))
+        self.assertEqual(
+            User.objects.get(username='bob').first_name, 'Bob')
+        self.assertEqual(
+            User.objects.get(username='carol').first_name, 'Carol')
+
+
+class CSVExportJobTest(TestCase):
+    def setUp(self):
+        self.queue_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.queue_dir)
+
+    def test_queue_files(self):
+        with self.settings(GENERIC_CSV_EXPORT_QUEUE_DIR=self.queue_dir):
+            job = CSVExportJob(id='a' * 32, status=CSVExportJob.PENDING)
+            job.save()
+            self.assertEqual(
+                CSVExportJob.load(job.id).status, CSVExportJob.PENDING)
+            with open(CSVExportJob.get_path(job.id), 'w') as job_file:
+                json.dump(job.__dict__, job_file) # i.e. not signed
+            self.assertRaises(ValueError, CSVExportJob.load, job.id)
+            self.assertEqual(CSVExportJob.get_runnable_ids(), [])
+            os.chmod(self.queue_dir, 0777)
+            self.assertRaises(ImproperlyConfigured, job.save)
+
+
+def get_full_name(user):
+    return user.get_full_name()
+
+
+class KeysetTest(TestCase):
+    def setUp(self):
+        for i, email in enumerate(('b@x', 'a@x', 'b@x', 'c@x', 'b@x')):
+            User.objects.create(username='u%d' % i, email=email)
+        self.queryset = User.objects.order_by('-email')
+        self.expected = list(self.queryset.order_by(
+            '-email', 'pk').values_list('pk', flat=True))
+
+    def test_get_keyset_ordering(self):
+        self.assertEqual(
+            querysets.get_keyset_ordering(self.queryset),
+            [('email', True), ('pk', False)],
+        )
+        self.assertEqual(
+            querysets.get_keyset_ordering(
+                User.objects.order_by('email', '-id', 'username')),
+            [('email', False), ('pk', True)],
+        )
+        for ordering in ('?', 'groups__name'):
+            self.assertEqual(
+                querysets.get_keyset_ordering(
+                    User.objects.order_by(ordering)),
+                None,
+            )
+
+    def test_iterate_keyset_chunks(self):
+        with CaptureQueriesContext(connection) as context:
+            chunks = list(querysets.iterate_keyset_chunks(self.queryset, 2))
+        self.assertEqual(map(len, chunks), [2, 2, 1])
+        self.assertEqual(
+            [obj.pk for chunk in chunks for obj in chunk], self.expected)
+        self.assertFalse(any(
+            'OFFSET' in query['sql'] for query in context.captured_queries))
+
+    def test_keyset_ranges(self):
+        ranges = list(querysets.iterate_keyset_ranges(self.queryset, 2))
+        self.assertEqual(len(ranges), 3)
+        self.assertEqual(
+            [
+                obj.pk for after, last in ranges for obj in
+                querysets.filter_keyset_range(self.queryset, after, last)
+            ],
+            self.expected,
+        )
+
+
+class CSVExportPlanTest(TestCase):
+    def setUp(self):
+        for username, email in (('c', 'a@x'), ('a', 'c@x'), ('b', 'b@x')):
+            User.objects.create(
+                username=username, email=email, first_name=username.upper())
+
+    def test_values(self):
+        plan = CSVExportPlan(
+            User, [('Username', 'username'), ('Email', 'email')])
+        self.assertFalse(plan.needs_instances)
+        queryset = User.objects.order_by('email')
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                list(plan.rows(queryset)),
+                [['c', 'a@x'], ['b', 'b@x'], ['a', 'c@x']],
+            )
+        # in chunks too, the queryset's ordering is kept
+        self.assertEqual(
+            [rows for last_pk, rows in plan.chunks(queryset, 2)],
+            [[['c', 'a@x'], ['b', 'b@x']], [['a', 'c@x']]],
+        )
+        self.assertEqual(
+            [row[0] for row in plan.rows(queryset.order_by('-pk'), 2)],
+            ['b', 'a', 'c'],
+        )
+        # resuming after a pk, by keyset
+        first_pk = User.objects.get(username='c').pk
+        self.assertEqual(
+            [rows for last_pk, rows in plan.chunks(queryset, 2, first_pk)],
+            [[['b', 'b@x'], ['a', 'c@x']]],
+        )
+
+    def test_instances(self):
+        plan = CSVExportPlan(
+            User, [('Username', 'username'), ('Name', get_full_name)])
+        self.assertTrue(plan.needs_instances)
+        self.assertEqual(
+            list(plan.rows(User.objects.order_by('username'), 2)),
+            [['a', 'A'], ['b', 'B'], ['c', 'C']],
+        )
+
+
+class UserCSVExportAdmin(CSVExportAdmin):
+    list_display = ('username', 'email')
+    csv_export_streaming = True
+    csv_export_chunk_size = 2
+
+    def csv_export_fields(self, request):
+        return [('Username', 'username')]
+
+
+class CSVExportAdminTest(TestCase):
+    def setUp(self):
+        for username, email in (('c', 'a@x'), ('a', 'c@x'), ('b', 'b@x')):
+            User.objects.create(username=username, email=email)
+        self.user = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'admin')
+        self.model_admin = UserCSVExportAdmin(User, admin.AdminSite())
+
+    def export(self, **params):
+        request = request_factory.get('/', params)
+        request.user = self.user
+        return ''.join(
+            self.model_admin.csv_export_view(request).streaming_content)
+
+    def test_change_list_ordering(self):
+        # columns are numbered after the action checkbox, as in the list
+        self.assertEqual(self.export(o='2').split(), [
+            'Username', 'c', 'admin', 'b', 'a']) # by email
+        self.assertEqual(self.export(o='-1').split(), [
+            'Username', 'c', 'b', 'admin', 'a'])
+
+
+class CSVExportParallelTest(TransactionTestCase):
+    def setUp(self):
+        name = connection.settings_dict['NAME']
+        if connection.vendor == 'sqlite' and (
+                name == ':memory:' or 'mode=memory' in name):
+            self.skipTest("worker processes can't share an in-memory db")
+        for i in range(7):
+            User.objects.create(username='u%d' % i, email='%d@x' % (i % 3))
+        self.user = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'admin')
+
+    def export(self, queryset, workers):
+        model_admin = UserCSVExportAdmin(User, admin.AdminSite())
+        model_admin.csv_export_workers = workers
+        request = request_factory.get('/')
+        request.user = self.user
+        f = cStringIO.StringIO()
+        model_admin.csv_export_to_file(request, queryset, f)
+        return f.getvalue()
+
+    def test_parallel(self):
+        for ordering in (('-pk',), ('email', 'pk')):
+            queryset = User.objects.order_by(*ordering)
+            serial = self.export(queryset, 1)
+            self.assertEqual(len(serial.splitlines()), 9)
+            self.assertEqual(self.export(queryset, 3), serial)
+
+
+class BatchUpdateAdminTest(TestCase):
+    def setUp(self):
+        self.model_admin = BatchUpdateAdmin(User, admin.AdminSite())
+        self.session = {}
+
+    def save_selection(self, pks):
+        request = request_factory.post(
+            '/', {admin.ACTION_CHECKBOX_NAME: pks})
+        request.session = self.session
+        return self.model_admin.save_batch_update_selection(
+            request, User.objects.all())
+
+    def get_selection(self, token):
+        request = request_factory.get('/', {'selection': token})
+        request.session = self.session
+        return self.model_admin.get_batch_update_selection(request)
+
+    def test_selection(self):
+        first = self.save_selection(['1', '2'])
+        self.assertEqual(self.get_selection(first)['pks'], ['1', '2'])
+        second = self.save_selection(['3'])
+        self.assertEqual(len(self.session), 1) # replaced the first
+        self.assertRaises(http.Http404, self.get_selection, first)
+        self.assertEqual(self.get_selection(second)['pks'], ['3'])
+        self.model_admin.batch_update_selection_timeout = -1
+        expired = self.save_selection(['4'])
+        self.assertRaises(http.Http404, self.get_selection, expired)
+
+    def test_chunked_apply(self):
+        users = [
+            User.objects.create(username=name) for name in ('a', 'b', 'c')]
+        model_admin = self.model_admin
+        model_admin.batch_update_fields = ('is_staff',)
+        model_admin.batch_update_chunked = True
+        model_admin.batch_update_chunk_size = 2
+        user_messages = []
+        model_admin.message_user = (
+            lambda request, message, **kwargs: user_messages.append(message))
+        request = request_factory.post('/')
+        request.user = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'admin')
+        form = model_admin.get_batch_update_form_class(request)(
+            {'is_staff': 'on', 'updating-is_staff': 'on'})
+        self.assertTrue(form.is_valid())
+        selection = {'pks': [str(user.pk) for user in users]}
+        self.assertEqual(
+            model_admin.batch_update_apply(request, form, selection), 3)
+        self.assertEqual(User.objects.filter(is_staff=True).count(), 4)
+        self.assertEqual(user_messages, [
+            u'The update was committed in 2 chunks of up to 2 objects'])
+
+    def test_preview_and_apply(self):
+        users = [
+            User.objects.create(username=str(i), first_name=first_name)
+            for i, first_name in enumerate(('Ann', 'Ann', 'Bob', 'Cy'))
+        ]
+        group = Group.objects.create(name='x')
+        users[2].groups.add(group)
+        model_admin = self.model_admin
+        model_admin.batch_update_fields = ('first_name', 'groups')
+        request = request_factory.post('/')
+        request.user = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'admin')
+        form = model_admin.get_batch_update_form_class(request)({
+            'first_name': 'Bob',
+            'updating-first_name': 'on',
+            'm2m_add_groups': [group.pk],
+            'updating-m2m_add_groups': 'on',
+        })
+        self.assertTrue(form.is_valid())
+        selection = {'pks': [str(user.pk) for user in users]}
+        count = model_admin.get_batch_update_count(request, selection)
+        self.assertEqual(count, 4)
+        preview = dict(
+            (row['label'], row) for row in
+            model_admin.get_batch_update_preview(
+                request, form, selection, count)
+        )
+        first_names = preview[form.fields['first_name'].label]
+        self.assertEqual(first_names['changes'], 3) # Bob already is
+        self.assertEqual(
+            sorted(first_names['values']),
+            [('Ann', 2), ('Bob', 1), ('Cy', 1)],
+        )
+        groups = preview[form.fields['m2m_add_groups'].label]
+        self.assertEqual(groups['changes'], 3)
+        self.assertEqual(groups['values'], [(u'0 of 1', 3), (u'1 of 1', 1)])
+
+        saved = []
+        def record_save(instance, **kwargs):
+            saved.append(instance.username)
+        signals.pre_save.connect(record_save, sender=User)
+        try:
+            updated = form.apply_in_chunks(
+                request,
+                model_admin.get_batch_update_chunks(request, selection),
+                save=True,
+            )
+        finally:
+            signals.pre_save.disconnect(record_save, sender=User)
+        self.assertEqual(updated, 3) # user 2 already had both
+        self.assertEqual(sorted(saved), ['0', '1', '3']) # not rewritten
+        self.assertEqual(
+            User.objects.filter(first_name='Bob', groups=group).count(), 4)
+
+    def test_save(self):
+        user = User.objects.create(username='a')
+        def set_first_name(instance, **kwargs):
+            instance.first_name = 'saved'
+        signals.pre_save.connect(set_first_name, sender=User)
+        try:
+            form = UserBatchUpdateForm()
+            self.assertEqual(form.apply_chunk(
+                User.objects.all(), {'is_staff': True}, [], save=True), 1)
+        finally:
+            signals.pre_save.disconnect(set_first_name, sender=User)
+        user = User.objects.get(pk=user.pk)
+        self.assertTrue(user.is_staff)
+        self.assertEqual(user.first_name, 'saved')
+
+
+class UserBatchUpdateForm(BatchUpdateForm):
+    class Meta:
+        model = User
+        fields = ('groups',)
+
+
+class BatchUpdateFormTest(TestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create(username=name) for name in ('a', 'b', 'c')]
+        self.groups = [
+            Group.objects.create(name=name) for name in ('x', 'y')]
+        self.users[0].groups.add(*self.groups)
+        self.users[1].groups.add(self.groups[0])
+        self.field = User._meta.get_field('groups')
+        self.form = UserBatchUpdateForm()
+        self.changes = []
+        signals.m2m_changed.connect(
+            self.m2m_changed, sender=User.groups.through)
+
+    def tearDown(self):
+        signals.m2m_changed.disconnect(
+            self.m2m_changed, sender=User.groups.through)
+
+    def m2m_changed(self, action, instance, reverse, pk_set, **kwargs):
+        self.assertTrue(reverse)
+        self.changes.append((action, instance.name, sorted(pk_set)))
+
+    def get_pairs(self):
+        return sorted(User.groups.through.objects.values_list(
+            'user__username', 'group__name'))
+
+    def test_add(self):
+        a, b, c = [user.pk for user in self.users]
+        self.assertEqual(
+            self.form.apply_m2m_add(
+                User.objects.all(), self.field, self.groups),
+            set([b, c]), # a already had both
+        )
+        self.assertEqual(self.get_pairs(), [
+            (u'a', u'x'), (u'a', u'y'), (u'b', u'x'), (u'b', u'y'),
+            (u'c', u'x'), (u'c', u'y'),
+        ])
+        self.assertEqual(sorted(self.changes), [
+            ('post_add', u'x', [c]), ('post_add', u'y', [b, c]),
+            ('pre_add', u'x', [c]), ('pre_add', u'y', [b, c]),
+        ])
+
+    def test_remove(self):
+        a, b, c = [user.pk for user in self.users]
+        self.assertEqual(
+            self.form.apply_m2m_remove(
+                User.objects.exclude(pk=a), self.field, self.groups),
+            set([b]), # c had neither
+        )
+        self.assertEqual(self.get_pairs(), [(u'a', u'x'), (u'a', u'y')])
+        self.assertEqual(sorted(self.changes), [
+            ('post_remove', u'x', [b]), ('pre_remove', u'x', [b]),
+        ])
+
+    def test_symmetrical(self):
+        a, b, c, d = [Relatable.objects.create() for i in range(4)]
+        d.related_items.add(b)
+        field = Relatable._meta.get_field('related_items')
+        form = self.form # its methods work for any model
+        form.apply_m2m_add(
+            Relatable.objects.filter(pk=a.pk), field, [b, c])
+        get_related = lambda obj: sorted(
+            obj.related_items.values_list('pk', flat=True))
+        self.assertEqual(get_related(a), [b.pk, c.pk])
+        self.assertEqual(get_related(b), [a.pk, d.pk])
+        self.assertEqual(get_related(c), [a.pk])
+        form.apply_m2m_remove(
+            Relatable.objects.filter(pk=d.pk), field, [b])
+        self.assertEqual(get_related(b), [a.pk])
+        self.assertEqual(get_related(d), [])
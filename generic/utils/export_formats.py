@@ -0,0 +1,311 @@
+"""
+Streaming serializers for tabular exports; see `CSVExportAdmin`.
+
+Each format is split into two stages so that the expensive part can be run
+in parallel and nothing ever needs the whole file in memory:
+
+- `encode_rows()` turns a block of rows into the encoded body of the file,
+  independently of any other block; and
+- `wrap()` turns the sequence of header, body blocks and footer into the
+  final output, incrementally (e.g. compressing or zipping it).
+"""
+import datetime
+import decimal
+import itertools
+import math
+import re
+import struct
+import time
+import zlib
+from xml.sax.saxutils import escape
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.encoding import force_text
+from . import unicode_csv
+
+
+class _Buffer(object):
+    """ Minimal file-like object which collects writes until drained """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def drain(self):
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class ExportFormat(object):
+    name = None
+    label = None
+    extension = None
+    content_type = None
+
+    def __init__(self, titles):
+        self.titles = [force_text(title) for title in titles]
+
+    def get_header(self):
+        return ''
+
+    def encode_rows(self, rows):
+        raise NotImplementedError
+
+    def get_footer(self):
+        return ''
+
+    def wrap(self, blocks):
+        return blocks
+
+    def serialize(self, row_blocks):
+        """ Yields the complete output for an iterable of blocks of rows """
+        return self.serialize_encoded(
+            itertools.imap(self.encode_rows, row_blocks))
+
+    def serialize_encoded(self, encoded_blocks):
+        """ As `serialize`, for blocks already passed through encode_rows """
+        def blocks():
+            yield self.get_header()
+            for data in encoded_blocks:
+                yield data
+            yield self.get_footer()
+        for data in self.wrap(blocks()):
+            if data:
+                yield data
+
+
+class CSVFormat(ExportFormat):
+    name = 'csv'
+    label = 'CSV'
+    extension = 'csv'
+    content_type = 'text/csv'
+
+    def __init__(self, titles):
+        super(CSVFormat, self).__init__(titles)
+        self.buffer = _Buffer()
+        self.writer = unicode_csv.Writer(self.buffer)
+
+    def get_header(self):
+        return self.encode_rows([self.titles])
+
+    def encode_rows(self, rows):
+        self.writer.writerows(rows)
+        return self.buffer.drain()
+
+
+class GzipCSVFormat(CSVFormat):
+    name = 'csv.gz'
+    label = 'gzip-compressed CSV'
+    extension = 'csv.gz'
+    content_type = 'application/gzip'
+    compression_level = 6
+
+    def wrap(self, blocks):
+        # wbits of 16 + MAX_WBITS gives gzip rather than zlib framing
+        compressor = zlib.compressobj(
+            self.compression_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for data in blocks:
+            yield compressor.compress(data)
+        yield compressor.flush()
+
+
+class _JSONEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        try:
+            return super(_JSONEncoder, self).default(o)
+        except TypeError:
+            return force_text(o) # e.g. related model instances
+
+
+class NDJSONFormat(ExportFormat):
+    """ One JSON object per line, keyed by column title """
+    name = 'ndjson'
+    label = 'NDJSON'
+    extension = 'ndjson'
+    content_type = 'application/x-ndjson'
+
+    def __init__(self, titles):
+        super(NDJSONFormat, self).__init__(titles)
+        self.encoder = _JSONEncoder(ensure_ascii=False)
+
+    def encode_rows(self, rows):
+        titles = self.titles
+        encode = self.encoder.encode
+        return u''.join(
+            encode(dict(zip(titles, row))) + u'\n' for row in rows
+        ).encode('utf-8')
+
+
+class _ZipStream(object):
+    """
+    Writes a zip archive sequentially, using data descriptors so that
+    nothing has to be seeked back to or held in memory. Archives are limited
+    to 4GB as zip64 is not supported.
+    """
+    def __init__(self):
+        self.offset = 0
+        self.entries = []
+        self.date_time = time.localtime()[:6]
+
+    def _write(self, data):
+        self.offset += len(data)
+        return data
+
+    def file(self, name, blocks):
+        """ Yields the archived form of a file with contents `blocks` """
+        year, month, day, hour, minute, second = self.date_time
+        dos_date = (year - 1980) << 9 | month << 5 | day
+        dos_time = hour << 11 | minute << 5 | second // 2
+        header_offset = self.offset
+        yield self._write(struct.pack(
+            '<4s5H3L2H', 'PK\x03\x04', 20, 0x08, zlib.DEFLATED,
+            dos_time, dos_date, 0, 0, 0, len(name), 0) + name)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        crc = size = compressed_size = 0
+        for data in blocks:
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+            data = compressor.compress(data)
+            compressed_size += len(data)
+            yield self._write(data)
+        data = compressor.flush()
+        compressed_size += len(data)
+        crc &= 0xffffffff
+        yield self._write(data + struct.pack(
+            '<4s3L', 'PK\x07\x08', crc, compressed_size, size))
+        self.entries.append((
+            name, dos_time, dos_date, crc, compressed_size, size,
+            header_offset,
+        ))
+
+    def close(self):
+        """ Returns the central directory which ends the archive """
+        directory = []
+        for (
+                name, dos_time, dos_date, crc, compressed_size, size,
+                header_offset
+        ) in self.entries:
+            directory.append(struct.pack(
+                '<4s6H3L5H2L', 'PK\x01\x02', 20, 20, 0x08, zlib.DEFLATED,
+                dos_time, dos_date, crc, compressed_size, size, len(name),
+                0, 0, 0, 0, 0, header_offset) + name)
+        directory = ''.join(directory)
+        return directory + struct.pack(
+            '<4s4H2LH', 'PK\x05\x06', 0, 0, len(self.entries),
+            len(self.entries), len(directory), self.offset, 0)
+
+
+# characters which are not allowed in XML 1.0 documents
+ILLEGAL_XML_CHARACTERS = re.compile(
+    u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+XLSX_FILES = (
+    ('[Content_Types].xml',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<Types xmlns="http://schemas.openxmlformats.org/package/2006/'
+     'content-types">'
+     '<Default Extension="rels" ContentType="application/'
+     'vnd.openxmlformats-package.relationships+xml"/>'
+     '<Default Extension="xml" ContentType="application/xml"/>'
+     '<Override PartName="/xl/workbook.xml" ContentType="application/'
+     'vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+     '<Override PartName="/xl/worksheets/sheet1.xml" ContentType='
+     '"application/'
+     'vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+     '</Types>'),
+    ('_rels/.rels',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/'
+     'relationships">'
+     '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/'
+     'officeDocument/2006/relationships/officeDocument" '
+     'Target="xl/workbook.xml"/>'
+     '</Relationships>'),
+    ('xl/workbook.xml',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/'
+     'main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/'
+     'relationships">'
+     '<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets>'
+     '</workbook>'),
+    ('xl/_rels/workbook.xml.rels',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/'
+     'relationships">'
+     '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/'
+     'officeDocument/2006/relationships/worksheet" '
+     'Target="worksheets/sheet1.xml"/>'
+     '</Relationships>'),
+)
+
+
+class XLSXFormat(ExportFormat):
+    """
+    A single-sheet, write-only workbook. Text (including dates) is written
+    as inline strings, so no shared string table has to be kept in memory.
+    """
+    name = 'xlsx'
+    label = 'Excel'
+    extension = 'xlsx'
+    content_type = (
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+    def encode_cell(self, value):
+        if value is None:
+            return '<c/>'
+        elif isinstance(value, bool):
+            return '<c t="b"><v>%d</v></c>' % value
+        elif isinstance(value, (int, long)):
+            return '<c><v>%d</v></c>' % value
+        elif isinstance(value, float) and not (
+                math.isinf(value) or math.isnan(value)):
+            # repr, as str() rounds to 12 significant digits
+            return '<c><v>%r</v></c>' % value
+        elif isinstance(value, decimal.Decimal) and value.is_finite():
+            return '<c><v>%s</v></c>' % value
+        # anything else, including NaN and infinity, is written as text
+        if isinstance(value, (datetime.date, datetime.time)):
+            value = value.isoformat()
+        value = ILLEGAL_XML_CHARACTERS.sub(u'', force_text(value))
+        return (
+            u'<c t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' %
+            escape(value)
+        ).encode('utf-8')
+
+    def encode_rows(self, rows):
+        encode_cell = self.encode_cell
+        return ''.join(
+            '<row>%s</row>' % ''.join(encode_cell(value) for value in row)
+            for row in rows
+        )
+
+    def get_header(self):
+        return (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<worksheet xmlns="http://schemas.openxmlformats.org/'
+            'spreadsheetml/2006/main"><sheetData>'
+        ) + self.encode_rows([self.titles])
+
+    def get_footer(self):
+        return '</sheetData></worksheet>'
+
+    def wrap(self, blocks):
+        archive = _ZipStream()
+        for name, content in XLSX_FILES:
+            for data in archive.file(name, [content]):
+                yield data
+        for data in archive.file('xl/worksheets/sheet1.xml', blocks):
+            yield data
+        yield archive.close()
+
+
+FORMATS = dict(
+    (format_class.name, format_class) for format_class in (
+        CSVFormat,
+        GzipCSVFormat,
+        NDJSONFormat,
+        XLSXFormat,
+    )
+)
@@ -0,0 +1,340 @@
+import operator
+
+from django.db import connections
+from django.db.models import Q
+
+# The most values to filter on with __in in one query, to stay within the
+# database's limit on query parameters (e.g. 999 for SQLite)
+IN_CHUNK_SIZE = 500
+
+
+def get_ordering(queryset):
+    """ Returns the ordering of `queryset`, explicit or the model's default """
+    query = queryset.query
+    if query.extra_order_by:
+        return list(query.extra_order_by)
+    elif query.order_by:
+        return list(query.order_by)
+    elif query.default_ordering:
+        return list(queryset.model._meta.ordering)
+    return []
+
+
+def _is_pk_ordering(queryset, field_name):
+    pk = queryset.model._meta.pk
+    return isinstance(field_name, basestring) and (
+        field_name.lstrip('-') in ('pk', pk.name, pk.attname))
+
+
+def get_pk_ordering(queryset):
+    """
+    Returns 'pk' or '-pk' if `queryset` is ordered by its pk alone ('pk' if
+    it isn't ordered at all), or None if it's ordered by anything else.
+    """
+    ordering = get_ordering(queryset)
+    if not ordering:
+        return 'pk'
+    elif len(ordering) == 1 and _is_pk_ordering(queryset, ordering[0]):
+        return '-pk' if ordering[0].startswith('-') else 'pk'
+    return None
+
+
+def order_by_pk_last(queryset):
+    """
+    Returns `queryset` with its pk added to its ordering if not already
+    there, so that its results are always in the same order.
+    """
+    ordering = get_ordering(queryset)
+    if any(_is_pk_ordering(queryset, field_name) for field_name in ordering):
+        return queryset
+    return queryset.order_by(*(ordering + ['pk']))
+
+
+def _get_pk_range_lookups(queryset):
+    """ Returns the lookups for after and up to a pk, in pk order """
+    if get_pk_ordering(queryset) == '-pk':
+        return '-pk', 'pk__lt', 'pk__gte'
+    return 'pk', 'pk__gt', 'pk__lte'
+
+
+def iterate_in_chunks(
+        queryset, chunk_size=1000, get_pk=operator.attrgetter('pk'),
+        after=None):
+    """
+    Yields lists of at most `chunk_size` objects from `queryset`, in pk order;
+    descending if `queryset` is ordered by '-pk'. Any other ordering is
+    replaced; see `iterate_ordered_chunks` to keep it.
+
+    Each chunk is fetched with its own `pk > last_pk` query (keyset
+    pagination), so memory use stays flat whatever the size of the queryset
+    and no server-side cursor is required.
+
+    `get_pk` extracts the pk from each result; e.g. `operator.itemgetter(0)`
+    for a `values_list('pk', ...)` queryset. If `after` is specified, only
+    results after that pk are included; e.g. to resume an iteration.
+    """
+    ordering, after_lookup, last_lookup = _get_pk_range_lookups(queryset)
+    queryset = queryset.order_by(ordering)
+    last_pk = after
+    while True:
+        chunk_queryset = queryset
+        if last_pk is not None:
+            chunk_queryset = chunk_queryset.filter(**{after_lookup: last_pk})
+        chunk = list(chunk_queryset[:chunk_size])
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            break
+        last_pk = get_pk(chunk[-1])
+
+
+def iterate_ordered_chunks(queryset, chunk_size=1000, offset=0):
+    """
+    Yields lists of at most `chunk_size` objects from `queryset` in its own
+    ordering, with the pk added to it to keep chunks consistent, skipping
+    the first `offset`; e.g. to resume an iteration.
+
+    Each chunk is fetched with its own LIMIT/OFFSET query, which works for
+    any ordering, but gets slower for later chunks as the database skips
+    over the earlier results; `iterate_in_chunks` is faster when the
+    ordering doesn't matter or is by pk, and `iterate_keyset_chunks` for
+    the orderings `get_keyset_ordering` accepts.
+    """
+    queryset = order_by_pk_last(queryset)
+    while True:
+        chunk = list(queryset[offset:offset + chunk_size])
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            break
+        offset += chunk_size
+
+
+def iterate(queryset, chunk_size=1000, get_pk=operator.attrgetter('pk')):
+    """ Flattened version of `iterate_in_chunks` """
+    for chunk in iterate_in_chunks(queryset, chunk_size, get_pk):
+        for obj in chunk:
+            yield obj
+
+
+def iterate_pk_ranges(queryset, chunk_size=1000):
+    """
+    Splits `queryset` into consecutive ranges of `chunk_size` results in pk
+    order (as for `iterate_in_chunks`), yielding an `(after, last)` pair of
+    pks for each; i.e. the range is `pk__gt=after, pk__lte=last` (or the
+    reverse, in descending order), where None means unbounded.
+
+    Only pks are read, with one indexed query per range.
+    """
+    ordering, after_lookup, last_lookup = _get_pk_range_lookups(queryset)
+    pks = queryset.order_by(ordering).values_list('pk', flat=True)
+    after = None
+    while True:
+        range_pks = pks if after is None else pks.filter(
+            **{after_lookup: after})
+        try:
+            last = range_pks[chunk_size - 1]
+        except IndexError:
+            yield after, None # remainder, if any
+            break
+        yield after, last
+        after = last
+
+
+def filter_pk_range(queryset, after, last):
+    """ Limits `queryset` to a range yielded by `iterate_pk_ranges` """
+    ordering, after_lookup, last_lookup = _get_pk_range_lookups(queryset)
+    if after is not None:
+        queryset = queryset.filter(**{after_lookup: after})
+    if last is not None:
+        queryset = queryset.filter(**{last_lookup: last})
+    return queryset
+
+
+def get_keyset_ordering(queryset):
+    """
+    Returns the ordering of `queryset` as (field name, descending) pairs
+    ending with the pk, if its results can be paged by keyset: i.e. it's
+    ordered by non-null fields of its own model. Returns None for orderings
+    which can't be compared that way, e.g. nullable, related or random.
+    """
+    fields = dict(
+        (field.attname if field.rel else field.name, field)
+        for field in queryset.model._meta.concrete_fields
+    )
+    keyset = []
+    for field_name in get_ordering(queryset):
+        if not isinstance(field_name, basestring):
+            return None
+        descending = field_name.startswith('-')
+        if _is_pk_ordering(queryset, field_name):
+            keyset.append(('pk', descending))
+            return keyset # the pk is unique, so nothing after it matters
+        field = fields.get(field_name.lstrip('-'))
+        if field is None or field.null:
+            return None
+        keyset.append((field_name.lstrip('-'), descending))
+    keyset.append(('pk', False))
+    return keyset
+
+
+def _order_by_keyset(queryset, keyset):
+    return queryset.order_by(*[
+        '-' + name if descending else name for name, descending in keyset])
+
+
+def _get_keyset_after_lookup(keyset, key):
+    """ Returns a Q for the results after `key`, in `keyset` order """
+    lookups = []
+    equal = {}
+    for (name, descending), value in zip(keyset, key):
+        lookup = dict(equal)
+        lookup['%s__%s' % (name, 'lt' if descending else 'gt')] = value
+        lookups.append(Q(**lookup))
+        equal[name] = value
+    return reduce(operator.or_, lookups)
+
+
+def get_keyset_key(queryset, pk):
+    """
+    Returns the values of the `get_keyset_ordering` fields of the object
+    with `pk`, e.g. to resume an iteration after it, or None if it's gone.
+    """
+    keyset = get_keyset_ordering(queryset)
+    keys = list(
+        queryset.model._default_manager.using(queryset.db).filter(pk=pk)
+        .values_list(*[name for name, descending in keyset])
+    )
+    return keys[0] if keys else None
+
+
+def iterate_keyset_chunks(queryset, chunk_size=1000, get_key=None, after=None):
+    """
+    Yields lists of at most `chunk_size` objects from `queryset` in its own
+    ordering, with the pk added to it, which `get_keyset_ordering` must
+    accept. As for `iterate_in_chunks`, each chunk is fetched with its own
+    query for the results after the last one, so later chunks are as cheap
+    as the first (given an index on the ordering).
+
+    `get_key` returns the values of the keyset fields of a result, in
+    order; by default, attributes of model instances. If `after` (such
+    values) is specified, only the results after it are included.
+    """
+    keyset = get_keyset_ordering(queryset)
+    if get_key is None:
+        get_key = lambda obj: tuple(
+            getattr(obj, name) for name, descending in keyset)
+    queryset = _order_by_keyset(queryset, keyset)
+    while True:
+        chunk_queryset = queryset
+        if after is not None:
+            chunk_queryset = chunk_queryset.filter(
+                _get_keyset_after_lookup(keyset, after))
+        chunk = list(chunk_queryset[:chunk_size])
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            break
+        after = get_key(chunk[-1])
+
+
+def iterate_keyset_ranges(queryset, chunk_size=1000):
+    """
+    As `iterate_pk_ranges`, for the orderings `get_keyset_ordering`
+    accepts; `after` and `last` are the values of the keyset fields. Only
+    those fields are read.
+    """
+    keyset = get_keyset_ordering(queryset)
+    keys = _order_by_keyset(queryset, keyset).values_list(
+        *[name for name, descending in keyset])
+    after = None
+    while True:
+        range_keys = keys if after is None else keys.filter(
+            _get_keyset_after_lookup(keyset, after))
+        try:
+            last = range_keys[chunk_size - 1]
+        except IndexError:
+            yield after, None # remainder, if any
+            break
+        yield after, last
+        after = last
+
+
+def filter_keyset_range(queryset, after, last):
+    """ Limits `queryset` to a range yielded by `iterate_keyset_ranges` """
+    keyset = get_keyset_ordering(queryset)
+    if after is not None:
+        queryset = queryset.filter(_get_keyset_after_lookup(keyset, after))
+    if last is not None:
+        queryset = queryset.exclude(_get_keyset_after_lookup(keyset, last))
+    return _order_by_keyset(queryset, keyset)
+
+
+def iterate_in(queryset, field_name, values, chunk_size=IN_CHUNK_SIZE):
+    """
+    Yields the results in `queryset` whose `field_name` is any of `values`,
+    filtering on at most `chunk_size` of them per query.
+    """
+    values = list(values)
+    for i in xrange(0, len(values), chunk_size):
+        for obj in queryset.filter(**{
+                '%s__in' % field_name: values[i:i + chunk_size]}):
+            yield obj
+
+
+def iterate_pk_in(queryset, pks, chunk_size=IN_CHUNK_SIZE):
+    """ `iterate_in` for pks """
+    return iterate_in(queryset, 'pk', pks, chunk_size)
+
+
+def bulk_update(model, objs_by_pk, fields, using, max_params=900):
+    """
+    Saves `fields` of the model instances `objs_by_pk` (a dict by pk) to
+    the existing rows with those pks, with one UPDATE of a CASE expression
+    per field per chunk of objects, rather than one per object.
+
+    Like `QuerySet.update()`, this bypasses `save()`, signals and
+    `pre_save()` (e.g. auto_now).
+    """
+    if not fields or not objs_by_pk:
+        return
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    pk_field = model._meta.pk
+    if connection.vendor == 'postgresql':
+        # otherwise NULLs and strings aren't assigned to e.g. integer columns
+        placeholder = lambda field: 'CAST(%%s AS %s)' % (
+            field.db_type(connection))
+    else:
+        placeholder = lambda field: '%s'
+    # each object takes a pk and value per field, and its pk for the WHERE
+    chunk_size = max(1, max_params // (2 * len(fields) + 1))
+    items = objs_by_pk.items()
+    cursor = connection.cursor()
+    for i in xrange(0, len(items), chunk_size):
+        chunk = [
+            (pk_field.get_db_prep_value(pk, connection), obj)
+            for pk, obj in items[i:i + chunk_size]
+        ]
+        assignments = []
+        params = []
+        for field in fields:
+            assignments.append('%s = CASE %s %s END' % (
+                qn(field.column),
+                qn(pk_field.column),
+                ' '.join(
+                    ['WHEN %%s THEN %s' % placeholder(field)] * len(chunk)),
+            ))
+            for pk, obj in chunk:
+                params.extend([pk, field.get_db_prep_save(
+                    getattr(obj, field.attname), connection)])
+        params.extend(pk for pk, obj in chunk)
+        cursor.execute(
+            'UPDATE %s SET %s WHERE %s IN (%s)' % (
+                qn(model._meta.db_table),
+                ', '.join(assignments),
+                qn(pk_field.column),
+                ', '.join(['%s'] * len(chunk)),
+            ),
+            params,
+        )
@@ -3,6 +3,7 @@
 import csv
 import cStringIO
 import codecs
+import types
 
 class UTF8Recoder:
     """
@@ -34,11 +35,33 @@ class Reader:
     def __iter__(self):
         return self
 
+def _encode_unicode(value):
+    return value.encode('utf-8')
+
+def _encode_str(value):
+    return value # assumed to be UTF-8 already
+
+def _encode_via_unicode(value):
+    return unicode(value).encode('utf-8')
+
+def _get_encoder(value):
+    if isinstance(value, unicode):
+        return _encode_unicode
+    elif isinstance(value, basestring):
+        return _encode_str
+    elif hasattr(value, '__unicode__'):
+        return _encode_via_unicode
+    elif hasattr(value, '__str__'):
+        return str
+    else:
+        raise NotImplementedError
+
 class Writer:
     """
     A CSV writer which will write rows to CSV file "f",
     which is encoded in the given encoding.
     """
+    batch_size = 1000
 
     def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
         # Redirect output to a queue
@@ -46,33 +69,50 @@ class Writer:
         self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
         self.stream = f
         self.encoder = codecs.getincrementalencoder(encoding)()
+        # no need to decode and reencode the queue if it's UTF-8 already
+        self.is_utf8 = codecs.lookup(encoding).name == 'utf-8'
+        # encoders are looked up once per type rather than once per value
+        self.encoders = {}
 
-    def writerow(self, row):
-        def stringify(value):
-            if isinstance(value, unicode):
-                pass
-            elif isinstance(value, basestring):
-                value = value.decode('utf-8')
-            elif hasattr(value, '__unicode__'):
-                value = unicode(value)
-            elif hasattr(value, '__str__'):
-                value = str(value).decode('utf-8')
-            else:
-                raise NotImplementedError
-            return value.encode('utf-8')
-        self.writer.writerow(map(stringify, row))
+    def encode_row(self, row):
+        encoders = self.encoders
+        encoded = []
+        for value in row:
+            value_type = type(value)
+            try:
+                encoder = encoders[value_type]
+            except KeyError:
+                encoder = _get_encoder(value)
+                if value_type is not types.InstanceType: # old-style class
+                    encoders[value_type] = encoder
+            encoded.append(encoder(value))
+        return encoded
+
+    def flush_queue(self):
         # Fetch UTF-8 output from the queue ...
         data = self.queue.getvalue()
-        data = data.decode("utf-8")
-        # ... and reencode it into the target encoding
-        data = self.encoder.encode(data)
+        if not self.is_utf8:
+            # ... and reencode it into the target encoding
+            data = self.encoder.encode(data.decode("utf-8"))
         # write to the target stream
         self.stream.write(data)
         # empty queue
         self.queue.truncate(0)
 
-    def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
-
+    def writerow(self, row):
+        self.writer.writerow(self.encode_row(row))
+        self.flush_queue()
 
+    def writerows(self, rows):
+        """
+        Writes rows to the queue in blocks of `batch_size`, so the queue is
+        only emptied into the target stream once per block.
+        """
+        writerow = self.writer.writerow
+        encode_row = self.encode_row
+        batch_size = self.batch_size
+        for i, row in enumerate(rows, 1):
+            writerow(encode_row(row))
+            if not i % batch_size:
+                self.flush_queue()
+        self.flush_queue()